@@ -0,0 +1,301 @@
+"""Offline benchmark for the processing stages in program.py
+
+Generates synthetic images, times every stage separately and writes the
+results as JSON so runs can be compared against a stored baseline:
+
+    python benchmark.py --sizes 1 4 12 --output results.json
+    python benchmark.py --baseline results.json
+
+The default "stub" model needs no network access or downloaded weights.
+Any real backend can be timed offline too, by running its pre- and
+post-processing on a tiny generated ONNX model:
+
+    python benchmark.py --model isnet-general-use --stand-in --optimization basic
+"""
+import argparse
+import importlib
+import io
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import PIL
+from PIL import Image, ImageDraw
+
+import program
+
+INPUT_FORMATS = ["PNG", "JPEG", "WEBP", "BMP", "GIF"]
+OUTPUT_FORMATS = ["PNG", "JPEG", "WEBP", "BMP"]
+
+# ----------------- STAND-IN MODELS -------------------------
+
+class StubSession:
+    """Deterministic stand-in for a rembg session
+
+    Follows the same cost profile as the real models: the input is resized
+    to the model resolution, a mask is "predicted" there (an ellipse around
+    the centre) and scaled back up to the input size.
+    """
+
+    def __init__(self, model_size=320):
+        self.model_size = model_size
+
+    def predict(self, img, *args, **kwargs):
+        size = (self.model_size, self.model_size)
+        img.convert("RGB").resize(size, Image.Resampling.LANCZOS)
+        mask = Image.new("L", size, 0)
+        margin = self.model_size // 6
+        ImageDraw.Draw(mask).ellipse(
+            (margin, margin, self.model_size - margin, self.model_size - margin), fill=255)
+        return [mask.resize(img.size, Image.Resampling.LANCZOS)]
+
+STAND_INS = {
+    "stub": StubSession,
+}
+
+def tiny_onnx_model(path):
+    """Write a tiny ONNX model shaped like the segmentation models
+
+    It takes any (N, 3, H, W) input and returns an (N, 1, H, W) "mask", so
+    every backend's pre- and post-processing runs for real through ONNX
+    Runtime without downloading weights. Needs the onnx package.
+    """
+    try:
+        import onnx
+        from onnx import TensorProto, helper
+    except ImportError:
+        raise SystemExit("--stand-in needs the onnx package (pip install onnx)") from None
+    image = helper.make_tensor_value_info("input", TensorProto.FLOAT, ["N", 3, "H", "W"])
+    mask = helper.make_tensor_value_info("output", TensorProto.FLOAT, ["N", 1, "H", "W"])
+    nodes = [helper.make_node("ReduceMean", ["input"], ["mean"], axes=[1], keepdims=1),
+             helper.make_node("Sigmoid", ["mean"], ["output"])]
+    graph = helper.make_graph(nodes, "stand_in", [image], [mask])
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    onnx.save(model, path)
+    return path
+
+def make_session(model, threads, **runtime):
+    """Build a session from a stand-in name, 'module:factory' or a backend name
+
+    runtime holds SessionManager settings such as model_path, inter_threads,
+    provider and optimization.
+    """
+    if model in STAND_INS:
+        return STAND_INS[model]()
+    if ":" in model:
+        module_name, _, factory = model.partition(":")
+        return getattr(importlib.import_module(module_name), factory)()
+    return program.SessionManager(model, threads, **runtime).create_session()
+
+# ----------------- SYNTHETIC IMAGES -------------------------
+
+def synthetic_image(megapixels):
+    """A reproducible 3:2 test photo with a subject in the middle"""
+    width = int(math.sqrt(megapixels * 1e6 * 1.5))
+    height = int(width / 1.5)
+    base = 512
+    red = Image.linear_gradient("L").resize((base, base))
+    green = Image.radial_gradient("L").resize((base, base))
+    blue = Image.effect_mandelbrot((base, base), (-2.0, -1.25, 0.75, 1.25), 64)
+    img = Image.merge("RGB", (red, green, blue))
+    draw = ImageDraw.Draw(img)
+    draw.ellipse((base // 4, base // 5, 3 * base // 4, 4 * base // 5), fill=(200, 120, 60))
+    draw.rectangle((base // 3, base // 3, base // 2, base // 2), fill=(30, 60, 200))
+    return img.resize((width, height), Image.Resampling.BICUBIC)
+
+def encode(img, file_format):
+    buf = io.BytesIO()
+    program.save_image(img, buf, file_format)
+    return buf.getvalue()
+
+# ----------------- TIMING -------------------------
+
+def time_stage(fn, repeat):
+    """Run fn repeat times and return (median, min) seconds and the last result"""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), min(timings), result
+
+def measure_throughput(predictor, img, concurrency, count):
+    """Seconds per image when concurrency callers share one (optionally batching) model"""
+    per_caller = max(1, count // concurrency)
+
+    def caller():
+        for _ in range(per_caller):
+            program.predict_mask(img, predictor)
+
+    threads = [threading.Thread(target=caller) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (time.perf_counter() - start) / (per_caller * concurrency)
+
+def run_benchmarks(sizes, formats, session, repeat, concurrency=1, batch_size=1):
+    results = []
+
+    def record(size, stage, file_format, fn):
+        median, best, result = time_stage(fn, repeat)
+        results.append({"megapixels": size, "stage": stage, "format": file_format,
+                        "median_s": round(median, 6), "min_s": round(best, 6)})
+        label = f"{stage} [{file_format}]" if file_format else stage
+        print(f"{size:>5} MP  {label:<24} {median * 1000:10.1f} ms")
+        return result
+
+    for size in sizes:
+        img = synthetic_image(size)
+        for file_format in formats:
+            data = encode(img, file_format)
+            record(size, "decode", file_format, lambda: program.decode_image(data))
+
+        src = program.decode_image(encode(img, "PNG"))
+        mask = record(size, "inference", None, lambda: program.predict_mask(src, session))
+        if concurrency > 1 or batch_size > 1:
+            predictor = session
+            if batch_size > 1:
+                predictor = program.InferenceScheduler(session, batch_size)
+            try:
+                per_image = statistics.median(
+                    measure_throughput(predictor, src, concurrency, 4 * concurrency)
+                    for _ in range(repeat))
+            finally:
+                if predictor is not session:
+                    predictor.close()
+            results.append({"megapixels": size, "stage": f"throughput_b{batch_size}_c{concurrency}",
+                            "format": None, "median_s": round(per_image, 6),
+                            "min_s": round(per_image, 6), "images_per_s": round(1 / per_image, 3)})
+            print(f"{size:>5} MP  {'throughput':<24} {1 / per_image:10.2f} images/s "
+                  f"(batch {batch_size}, {concurrency} callers)")
+        cutout = record(size, "cutout", None, lambda: program.apply_mask(src, mask))
+        record(size, "magic_gradient", None,
+               lambda: program.make_gradient(cutout.size, *program.GRADIENT_PRESETS["magic"]))
+        record(size, "magic", None, lambda: program.effect_magic(cutout))
+        for effect in ("blur", "sharpen", "grayscale"):
+            record(size, effect, None, lambda e=effect: program.apply_effects(cutout, [(e, ())]))
+        record(size, "composite_color", None, lambda: program.effect_bg_color(cutout, "#ffffff"))
+        backdrop = src.transpose(Image.Transpose.ROTATE_90).convert("RGBA")
+        background = record(size, "fit_background", None,
+                            lambda: program.fit_background(backdrop, cutout.size))
+        record(size, "composite_image", None, lambda: program.composite(cutout, background))
+        record(size, "blur_premultiplied", None,
+               lambda: program.apply_effects(cutout, [("blur", ())], premultiplied=True))
+        for file_format in OUTPUT_FORMATS:
+            record(size, "save", file_format, lambda f=file_format: encode(cutout, f))
+    return results
+
+# ----------------- BASELINES -------------------------
+
+def result_key(result):
+    return (result["megapixels"], result["stage"], result["format"])
+
+def compare(results, baseline, tolerance):
+    """Print per-stage ratios against a baseline and return the regressions"""
+    previous = {result_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get(result_key(result))
+        if not old or not old["median_s"]:
+            continue
+        ratio = result["median_s"] / old["median_s"]
+        if ratio > 1 + tolerance:
+            regressions.append((result, ratio))
+        label = result["stage"] + (f" [{result['format']}]" if result["format"] else "")
+        print(f"{result['megapixels']:>5} MP  {label:<24} {ratio:6.2f}x"
+              f"{'  REGRESSION' if ratio > 1 + tolerance else ''}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Magical Background Remover stages")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 4, 12, 24, 50],
+                        help="image sizes in megapixels")
+    parser.add_argument("--formats", type=str.upper, nargs="+", default=INPUT_FORMATS,
+                        choices=INPUT_FORMATS, help="input formats to decode")
+    parser.add_argument("--model", default="stub",
+                        help="'stub', 'module:factory' or a backend name such as "
+                             f"{', '.join(program.MODEL_TIERS.values())}")
+    parser.add_argument("--tier", choices=program.MODEL_TIERS,
+                        help="benchmark the model of a speed/quality tier instead of --model")
+    parser.add_argument("--model-path", help="local ONNX file to run with the backend")
+    parser.add_argument("--stand-in", action="store_true",
+                        help="run the backend on a tiny generated ONNX model (no downloads)")
+    parser.add_argument("--threads", type=int, default=0, help="ONNX Runtime intra-op threads")
+    parser.add_argument("--inter-threads", type=int, default=0,
+                        help="ONNX Runtime inter-op threads")
+    parser.add_argument("--provider", default=None, help="ONNX Runtime execution provider")
+    parser.add_argument("--optimization", default="all",
+                        choices=program.GRAPH_OPTIMIZATION_LEVELS,
+                        help="ONNX Runtime graph optimization level")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="concurrent callers for the inference throughput stage")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="micro-batch size for the inference throughput stage")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare against a previous results file")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="allowed slowdown before a stage counts as a regression")
+    args = parser.parse_args(argv)
+
+    model = program.MODEL_TIERS[args.tier] if args.tier else args.model
+    model_path = args.model_path
+    if args.stand_in:
+        model_path = tiny_onnx_model(os.path.join(tempfile.mkdtemp(), "stand_in.onnx"))
+    try:
+        session = make_session(model, args.threads, model_path=model_path,
+                               inter_threads=args.inter_threads, provider=args.provider,
+                               optimization=args.optimization)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.batch_size > 1 and program.InferenceScheduler.batch_spec(session) is None:
+        parser.error(f"--batch-size needs a model that runs batches (e.g. --model u2net "
+                     f"--stand-in); '{model}' predicts one image at a time")
+    results = run_benchmarks(args.sizes, args.formats, session, args.repeat,
+                             args.concurrency, args.batch_size)
+    report = {
+        "meta": {
+            "model": model,
+            "model_path": args.model_path,
+            "stand_in": args.stand_in,
+            "threads": args.threads,
+            "inter_threads": args.inter_threads,
+            "provider": args.provider,
+            "optimization": args.optimization,
+            "repeat": args.repeat,
+            "concurrency": args.concurrency,
+            "batch_size": args.batch_size,
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} stage(s) slower than baseline by more than "
+                  f"{args.tolerance:.0%}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
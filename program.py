@@ -1,13 +1,2089 @@
+import time
+
+# Startup timings are measured from here, so they include the imports below
+STARTED = time.perf_counter()
+
+import argparse
+import asyncio
+import glob
+import hashlib
+import io
+import itertools
+import json
 import os
+import queue
+import signal
+import sys
 import threading
-from rembg import remove  # type: ignore
-from PIL import Image, ImageTk, ImageEnhance, ImageFilter, ImageOps
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+from PIL import (Image, ImageChops, ImageColor, ImageTk, ImageFilter, ImageOps, ImageStat,
+                 UnidentifiedImageError)
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, colorchooser
 from tkinterdnd2 import DND_FILES, TkinterDnD  # type: ignore
 
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+IMPORTED = time.perf_counter()
+
+# ----------------- INSTRUMENTATION -------------------------
+
+def peak_rss_bytes():
+    """Peak resident memory of this process so far, or None if unavailable"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+class Tracer:
+    """Cheap timing spans kept in a rolling, exportable trace
+
+    Spans opened inside an operation on the same thread are also collected
+    into that operation's breakdown, which the UI shows for the last action.
+    """
+
+    def __init__(self, max_records=5000):
+        self.records = deque(maxlen=max_records)
+        self.last_operation = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    @contextmanager
+    def span(self, name, **fields):
+        """Time a block; the yielded dict can be filled in with details like size"""
+        info = dict(fields)
+        peak_before = peak_rss_bytes()
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            record = {"name": name, "time": time.time(),
+                      "seconds": time.perf_counter() - start,
+                      "thread": threading.current_thread().name}
+            peak = peak_rss_bytes()
+            if peak is not None:
+                record["peak_rss"] = peak
+                record["peak_rss_growth"] = peak - peak_before
+            if "size" in info:
+                info["size"] = list(info["size"])
+            record.update(info)
+            self._add(record)
+            spans = getattr(self._local, "spans", None)
+            if spans is not None:
+                spans.append(record)
+
+    @contextmanager
+    def operation(self, name):
+        """Group the spans of one user-visible action"""
+        if getattr(self._local, "spans", None) is not None:
+            # Nested inside another operation: its spans belong to the outer one
+            yield
+            return
+        self._local.spans = []
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            spans, self._local.spans = self._local.spans, None
+            record = {"name": name, "kind": "operation", "time": time.time(),
+                      "seconds": time.perf_counter() - start,
+                      "spans": [(span["name"], span["seconds"]) for span in spans],
+                      "peak_rss": peak_rss_bytes()}
+            self._add(record)
+            self.last_operation = record
+
+    def summary(self):
+        """One line breakdown of the last operation"""
+        op = self.last_operation
+        if op is None:
+            return ""
+        parts = " · ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in op["spans"])
+        text = f"{op['name']}: {op['seconds'] * 1000:.0f} ms"
+        if parts:
+            text += f" ({parts})"
+        if op["peak_rss"]:
+            text += f" · peak {op['peak_rss'] / 1024 ** 2:.0f} MB"
+        return text
+
+    def export(self, path):
+        """Write the rolling trace as JSON lines"""
+        with self._lock:
+            records = list(self.records)
+        with open(path, "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        return len(records)
+
+# ----------------- MODEL SESSION -------------------------
+
+# numpy, ONNX Runtime and rembg (which pulls in scipy and pymatting) take
+# seconds to import, so they are loaded on first use instead of at startup
+np = None
+ort = None
+_stack_lock = threading.Lock()
+
+# Segmentation backends by model name. A backend is called like a rembg
+# session class, backend(model_name, sess_opts, providers, **kwargs), and
+# what it returns must provide predict(img) -> [mask]. rembg's models are
+# added when the segmentation stack is loaded.
+BACKENDS = {}
+
+# Speed/quality tiers and the model each one uses
+MODEL_TIERS = {"fast": "u2netp", "balanced": "u2net", "quality": "isnet-general-use"}
+
+# ONNX Runtime GraphOptimizationLevel members by option name
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disabled": "ORT_DISABLE_ALL",
+    "basic": "ORT_ENABLE_BASIC",
+    "extended": "ORT_ENABLE_EXTENDED",
+    "all": "ORT_ENABLE_ALL",
+}
+
+def load_segmentation_stack():
+    """Import numpy, ONNX Runtime and rembg's models, once"""
+    global np, ort
+    with _stack_lock:
+        if ort is not None:
+            return
+        # rembg imports pymatting, whose numba kernels start numba's thread
+        # pool on import. The TBB pool started off the main thread (as the
+        # app does) makes the interpreter hang on exit, and the kernels are
+        # only used for alpha matting, which is not used here.
+        os.environ.setdefault("NUMBA_THREADING_LAYER", "workqueue")
+        import numpy
+        import onnxruntime  # type: ignore
+        from rembg.sessions import sessions_class  # type: ignore
+        for session_class in sessions_class:
+            BACKENDS.setdefault(session_class.name(), session_class)
+        np = numpy
+        ort = onnxruntime
+
+def backends():
+    """Every selectable model name; loads the segmentation stack"""
+    load_segmentation_stack()
+    return list(BACKENDS)
+
+def register_backend(name, backend):
+    """Make a segmentation backend selectable by model name"""
+    BACKENDS[name] = backend
+
+def local_model_backend(backend, model_path):
+    """A rembg backend that runs a local ONNX file instead of downloading its weights
+
+    The backend's own pre- and post-processing is kept, so a quantized
+    export of a model can be dropped in for it.
+    """
+    class LocalModelSession(backend):
+        @classmethod
+        def download_models(cls, *args, **kwargs):
+            return os.path.abspath(os.path.expanduser(model_path))
+    return LocalModelSession
+
+class SessionManager:
+    """Create one segmentation session and share it between every caller
+
+    model_path runs a local ONNX file with the chosen model's pre- and
+    post-processing ("u2net_custom" for a U2-Net style export). Runtime
+    settings are ONNX Runtime's intra/inter-op thread counts (0 = auto),
+    execution provider and graph optimization level.
+    """
+
+    def __init__(self, model_name="u2net", num_threads=0, max_batch=1, max_wait=0.01,
+                 inter_threads=0, provider=None, optimization="all", model_path=None):
+        if model_name == "u2net_custom" and not model_path:
+            raise ValueError("the u2net_custom model needs a model_path")
+        if optimization not in GRAPH_OPTIMIZATION_LEVELS:
+            raise ValueError(f"optimization must be one of {', '.join(GRAPH_OPTIMIZATION_LEVELS)}")
+        self.model_name = model_name
+        self.num_threads = num_threads
+        self.inter_threads = inter_threads
+        self.provider = provider
+        self.optimization = optimization
+        self.model_path = model_path
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.error = None
+        self._session = None
+        self._scheduler = None
+        self._siblings = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def validate(self):
+        """Load the segmentation stack and check the model and provider exist"""
+        load_segmentation_stack()
+        if self.model_name not in BACKENDS:
+            raise ValueError(f"Unknown model '{self.model_name}' "
+                             f"(choose from {', '.join(BACKENDS)})")
+        if self.provider and self.provider not in ort.get_available_providers():
+            raise ValueError(f"Execution provider '{self.provider}' is not available "
+                             f"(available: {', '.join(ort.get_available_providers())})")
+
+    def create_session(self, num_threads=None):
+        """Build a new session with the configured runtime settings"""
+        self.validate()
+        if num_threads is None:
+            num_threads = self.num_threads
+        sess_opts = ort.SessionOptions()
+        if num_threads:
+            sess_opts.intra_op_num_threads = num_threads
+        if self.inter_threads:
+            sess_opts.inter_op_num_threads = self.inter_threads
+        sess_opts.graph_optimization_level = getattr(
+            ort.GraphOptimizationLevel, GRAPH_OPTIMIZATION_LEVELS[self.optimization])
+        backend = BACKENDS[self.model_name]
+        kwargs = {}
+        if self.model_path:
+            backend = local_model_backend(backend, self.model_path)
+            kwargs["model_path"] = self.model_path
+        providers = [self.provider] if self.provider else None
+        return backend(self.model_name, sess_opts, providers, **kwargs)
+
+    def for_model(self, model_name):
+        """A manager for another model with the same runtime settings, created once"""
+        if model_name == self.model_name:
+            return self
+        with self._lock:
+            if model_name not in self._siblings:
+                self._siblings[model_name] = SessionManager(
+                    model_name, self.num_threads, self.max_batch, self.max_wait,
+                    self.inter_threads, self.provider, self.optimization)
+            return self._siblings[model_name]
+
+    def for_tier(self, tier):
+        """The manager for a speed/quality tier: fast, balanced or quality"""
+        if tier not in MODEL_TIERS:
+            raise ValueError(f"tier must be one of {', '.join(MODEL_TIERS)}")
+        return self.for_model(MODEL_TIERS[tier])
+
+    def get(self):
+        """Return the shared session, creating it on first use"""
+        with self._lock:
+            if self._session is None:
+                self._session = self.create_session()
+                self._ready.set()
+            return self._session
+
+    def predictor(self):
+        """What callers should predict with: the shared session, or a batching
+        scheduler in front of it when max_batch > 1"""
+        session = self.get()
+        if self.max_batch <= 1:
+            return session
+        with self._lock:
+            if self._scheduler is None:
+                self._scheduler = InferenceScheduler(session, self.max_batch, self.max_wait)
+            return self._scheduler
+
+    def is_ready(self):
+        """True once the session has been created"""
+        return self._ready.is_set()
+
+    def settings(self):
+        """Settings that change the predicted mask, used in cache keys"""
+        settings = {"model": self.model_name,
+                    "large_image": (LARGE_IMAGE_PIXELS, INFERENCE_MAX_SIDE)}
+        if self.model_path:
+            stat = os.stat(self.model_path)
+            settings["model_file"] = (os.path.abspath(self.model_path), stat.st_size,
+                                      stat.st_mtime_ns)
+        return settings
+
+    def warm(self):
+        """Load the model and run a tiny inference, recording any failure in error"""
+        try:
+            session = self.get()
+            # A constant image would make rembg's normalisation divide by zero
+            session.predict(Image.radial_gradient("L").resize((64, 64)).convert("RGB"))
+            self.error = None
+        except Exception as e:
+            self.error = e
+            raise
+
+    def warm_up(self):
+        """Load the model and run a tiny inference on a background thread"""
+        def worker():
+            try:
+                self.warm()
+            except Exception:
+                pass
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+# Preprocessing used by rembg's single-output models: (mean, std, input size)
+BATCHABLE_MODELS = {
+    "u2net": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "u2netp": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "u2net_human_seg": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "u2net_custom": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "silueta": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "isnet-general-use": ((0.485, 0.456, 0.406), (1.0, 1.0, 1.0), (1024, 1024)),
+}
+
+class InferenceScheduler:
+    """Collect predictions from concurrent callers into batched model runs
+
+    Callers preprocess on their own thread and block in predict(); a single
+    scheduler thread stacks up to max_batch inputs (waiting at most max_wait
+    seconds for more to arrive), runs the model once and hands each caller
+    its own output. Behaves like a rembg session, so it can be passed
+    anywhere a session is expected.
+    """
+
+    def __init__(self, session, max_batch=4, max_wait=0.01):
+        self.session = session
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.spec = self.batch_spec(session)
+        self.batches = 0
+        self.batched_images = 0
+        self._queue = queue.Queue()
+        if self.spec:
+            thread = threading.Thread(target=self._loop, daemon=True)
+            thread.start()
+
+    @staticmethod
+    def batch_spec(session):
+        """Preprocessing (mean, std, size) if the session can run batches, else None"""
+        spec = BATCHABLE_MODELS.get(getattr(session, "model_name", None))
+        if spec:
+            batch_dim = session.inner_session.get_inputs()[0].shape[0]
+            if isinstance(batch_dim, int) and batch_dim == 1:
+                return None
+        return spec
+
+    def close(self):
+        """Stop the scheduler thread once the queued predictions have run"""
+        if self.spec:
+            self._queue.put(None)
+
+    def predict(self, img, *args, **kwargs):
+        """Return [mask] for one image, like BaseSession.predict"""
+        if self.spec is None:
+            return self.session.predict(img)
+        mean, std, size = self.spec
+        inputs = self.session.normalize(img, mean, std, size)
+        future = Future()
+        self._queue.put((next(iter(inputs.values())), future))
+        pred = future.result()
+
+        # Same post-processing as rembg's sessions
+        ma, mi = np.max(pred), np.min(pred)
+        pred = (pred - mi) / (ma - mi)
+        mask = Image.fromarray((pred * 255).astype("uint8"), mode="L")
+        return [mask.resize(img.size, Image.Resampling.LANCZOS)]
+
+    def _loop(self):
+        closed = False
+        while not closed:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    closed = True
+                    break
+                batch.append(item)
+            self._run(batch)
+
+    def _run(self, batch):
+        name = self.session.inner_session.get_inputs()[0].name
+        try:
+            if len(batch) == 1:
+                outputs = self.session.inner_session.run(None, {name: batch[0][0]})
+            else:
+                stacked = np.concatenate([tensor for tensor, _ in batch])
+                outputs = self.session.inner_session.run(None, {name: stacked})
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.batched_images += len(batch)
+        for i, (_, future) in enumerate(batch):
+            future.set_result(outputs[0][i, 0])
+
+def decode_image(data):
+    """Decode image bytes and apply the EXIF orientation"""
+    try:
+        img = Image.open(io.BytesIO(data))
+    except UnidentifiedImageError:
+        raise ValueError("not a recognised image file") from None
+    img.load()
+    return ImageOps.exif_transpose(img)
+
+# ----------------- IMAGE LOADING -------------------------
+
+class ImageLoader:
+    """Fast preview loading with reduced-scale decoding and a thumbnail cache
+
+    Only the preview is decoded when a file is loaded; the full image is
+    decoded later by decode_image when processing actually needs it.
+    """
+
+    def __init__(self, cache_size=32):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def preview(self, path, size=(300, 300)):
+        """Return (thumbnail, oriented full size) for an image file"""
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, size)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        with Image.open(path) as img:
+            full_size = img.size
+            if img.getexif().get(0x0112) in (5, 6, 7, 8):
+                full_size = full_size[::-1]
+            # JPEG can decode straight to a 1/2, 1/4 or 1/8 scale image;
+            # ask for a square so rotated images still get enough pixels
+            img.draft(None, (max(size), max(size)))
+            thumb = ImageOps.exif_transpose(img)
+            thumb.thumbnail(size, Image.Resampling.LANCZOS)
+
+        with self._lock:
+            self._cache[key] = (thumb, full_size)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return thumb, full_size
+
+# ----------------- SEGMENTATION -------------------------
+
+# Images above this many pixels are segmented from a reduced copy and
+# composited tile by tile so memory stays bounded
+LARGE_IMAGE_PIXELS = 16 * 1000 * 1000
+INFERENCE_MAX_SIDE = 2048
+TILE_SIZE = 1024
+
+# Guided filter window radius, in low resolution mask pixels, and its
+# regularization on 0-1 intensities: lower eps keeps more source edges
+GUIDED_FILTER_EPS = 1e-3
+GUIDED_FILTER_RADIUS = 2
+
+def is_large_image(img):
+    return img.width * img.height > LARGE_IMAGE_PIXELS
+
+def iter_tiles(size, tile_size=TILE_SIZE):
+    """Yield (left, upper, right, lower) boxes covering an image"""
+    width, height = size
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            yield (left, top, min(left + tile_size, width), min(top + tile_size, height))
+
+def predict_mask(img, session):
+    """Run the segmentation model and return the alpha mask"""
+    if not is_large_image(img):
+        return session.predict(img)[0]
+
+    # The model works at a fixed small resolution anyway, so infer on a bounded copy
+    factor = -(-max(img.size) // INFERENCE_MAX_SIDE)
+    small = img.reduce(factor) if factor > 1 else img
+    return refine_mask(session.predict(small.convert("RGB"))[0], img)
+
+def box_mean(a, radius):
+    """Mean over a (2 * radius + 1) square window, with edge values repeated"""
+    size = 2 * radius + 1
+    padded = np.pad(a, radius, mode="edge").cumsum(0).cumsum(1)
+    padded = np.pad(padded, ((1, 0), (1, 0)))
+    sums = (padded[size:, size:] - padded[:-size, size:]
+            - padded[size:, :-size] + padded[:-size, :-size])
+    return sums / (size * size)
+
+def guided_filter_coefficients(guide, src, radius, eps=GUIDED_FILTER_EPS):
+    """Per pixel (a, b) so that a * guide + b fits src locally (He et al.'s guided filter)"""
+    mean_i = box_mean(guide, radius)
+    mean_p = box_mean(src, radius)
+    var_i = box_mean(guide * guide, radius) - mean_i * mean_i
+    cov_ip = box_mean(guide * src, radius) - mean_i * mean_p
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    return box_mean(a, radius), box_mean(b, radius)
+
+def refine_mask(small_mask, img):
+    """Upsample a low resolution mask so its edge follows the full resolution image"""
+    size = img.size
+    mask = small_mask.resize(size, Image.Resampling.BILINEAR)
+
+    # Fit the mask to the source at low resolution, then apply the fit to
+    # the full resolution source so its edges carry into the mask
+    guide = np.asarray(img.resize(small_mask.size, Image.Resampling.BOX).convert("L"),
+                       dtype=np.float64) / 255
+    alpha = np.asarray(small_mask, dtype=np.float64) / 255
+    a, b = (Image.fromarray(c.astype(np.float32))
+            for c in guided_filter_coefficients(guide, alpha, GUIDED_FILTER_RADIUS))
+
+    # The uncertain band is found at low resolution, then only the tiles it
+    # touches are refined at full resolution
+    band = small_mask.point(lambda v: 255 if 16 <= v <= 239 else 0)
+    band = band.filter(ImageFilter.MaxFilter(3)).resize(size, Image.Resampling.NEAREST)
+    scale_x, scale_y = small_mask.width / size[0], small_mask.height / size[1]
+    for box in iter_tiles(size):
+        band_tile = band.crop(box)
+        if band_tile.getbbox() is None:
+            continue
+        tile_size = (box[2] - box[0], box[3] - box[1])
+        small_box = (box[0] * scale_x, box[1] * scale_y, box[2] * scale_x, box[3] * scale_y)
+        a_tile, b_tile = (np.asarray(c.resize(tile_size, Image.Resampling.BILINEAR, small_box))
+                          for c in (a, b))
+        guide_tile = np.asarray(img.crop(box).convert("L"), dtype=np.float32) / 255
+        refined = (a_tile * guide_tile + b_tile).clip(0, 1)
+        mask.paste(Image.fromarray((refined * 255 + 0.5).astype(np.uint8)), box[:2], band_tile)
+    return mask
+
+def apply_mask(img, mask):
+    """Cut the subject out of an image using its alpha mask"""
+    if not is_large_image(img):
+        empty = Image.new("RGBA", img.size, 0)
+        return Image.composite(img.convert("RGBA"), empty, mask)
+
+    cutout = Image.new("RGBA", img.size, 0)
+    for box in iter_tiles(img.size):
+        mask_tile = mask.crop(box)
+        if mask_tile.getbbox() is None:
+            continue
+        cutout.paste(img.crop(box).convert("RGBA"), box[:2], mask_tile)
+    return cutout
+
+# ----------------- MASK CACHE -------------------------
+
+class MaskCache:
+    """On-disk cache of alpha masks keyed by source content, with LRU eviction"""
+
+    def __init__(self, directory=None, max_bytes=512 * 1024 * 1024):
+        self.directory = directory or os.environ.get("BGREMOVER_CACHE_DIR") or \
+            os.path.join(os.path.expanduser("~"), ".cache", "magical-bg-remover", "masks")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Oldest first, so the front of the dict is the next to be evicted
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".png"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._total += size
+
+    def key(self, data, settings):
+        """Hash the source bytes together with the settings that affect the mask"""
+        digest = hashlib.sha256(data)
+        digest.update(repr(sorted(settings.items())).encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.png")
+
+    def get(self, key):
+        """Return the cached mask for a key, or None"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+        try:
+            mask = Image.open(self._path(key))
+            mask.load()
+            os.utime(self._path(key))
+        except (OSError, ValueError):
+            with self._lock:
+                self._total -= self._entries.pop(key, 0)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return mask
+
+    def put(self, key, mask):
+        """Store a mask and evict least recently used entries over budget"""
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            mask.convert("L").save(tmp_path, "PNG", optimize=True)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self._lock:
+            self._total += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            while self._total > self.max_bytes and len(self._entries) > 1:
+                old_key, old_size = self._entries.popitem(last=False)
+                self._total -= old_size
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+
+    def stats_text(self):
+        """Short hit/miss summary for the status bar"""
+        return f"Mask cache: {self.hits} hits / {self.misses} misses"
+
+def compute_mask(data, img, session, settings, cache=None):
+    """Return the mask for decoded image bytes, consulting the cache first"""
+    key = cache.key(data, settings) if cache else None
+    mask = cache.get(key) if cache else None
+    if mask is None or mask.size != img.size:
+        mask = predict_mask(img, session)
+        if cache:
+            cache.put(key, mask)
+    return mask
+
+# ----------------- COMPOSITING -------------------------
+
+FIT_MODES = ("cover", "contain", "stretch")
+
+def fit_background(img, size, fit="cover"):
+    """Resize a background to size: crop to fill (cover), letterbox (contain) or stretch"""
+    if fit == "cover":
+        return ImageOps.fit(img, size, Image.Resampling.LANCZOS)
+    if fit == "contain":
+        return ImageOps.pad(img, size, Image.Resampling.LANCZOS, color=(0, 0, 0, 0))
+    if fit == "stretch":
+        return img.resize(size, Image.Resampling.LANCZOS)
+    raise ValueError(f"fit must be one of {', '.join(FIT_MODES)}")
+
+def composite(fg, bg):
+    """Blend fg over bg in one whole-image Image.alpha_composite"""
+    return Image.alpha_composite(bg.convert("RGBA"), fg.convert("RGBA"))
+
+class BackgroundCache:
+    """Decoded background images, fitted once per target size and fit mode
+
+    A batch that puts every cutout on the same background decodes it once
+    and resizes it once per distinct cutout size. Entries are evicted
+    least recently used first to stay within max_bytes.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        with self._lock:
+            img = self._entries.get(key)
+            if img is not None:
+                self._entries.move_to_end(key)
+            return img
+
+    def _store(self, key, img):
+        size = image_bytes(img)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = img
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self._bytes -= image_bytes(old)
+
+    def get(self, path, size, fit="cover"):
+        """Return the background at path fitted to size (shared; do not modify)"""
+        source_key = (os.path.abspath(path), os.stat(path).st_mtime_ns)
+        key = source_key + (tuple(size), fit)
+        fitted = self._lookup(key)
+        if fitted is None:
+            source = self._lookup(source_key)
+            if source is None:
+                with Image.open(path) as img:
+                    img.load()
+                    source = ImageOps.exif_transpose(img).convert("RGBA")
+                self._store(source_key, source)
+            fitted = fit_background(source, tuple(size), fit)
+            self._store(key, fitted)
+        return fitted
+
+BACKGROUNDS = BackgroundCache()
+
+# ----------------- EFFECTS -------------------------
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".webp", ".gif", ".tif", ".tiff")
+
+# Vertical gradients as (top color, bottom color)
+GRADIENT_PRESETS = {
+    "magic": ((255, 255, 255), (215, 195, 175)),
+    "sunset": ((255, 236, 210), (252, 182, 159)),
+    "ocean": ((224, 242, 254), (125, 176, 228)),
+    "mint": ((240, 253, 244), (167, 224, 190)),
+}
+
+def make_gradient(size, top, bottom):
+    """Build a vertical RGBA gradient without touching individual pixels"""
+    width, height = size
+    ramp = Image.linear_gradient("L").resize((1, height), Image.Resampling.BILINEAR)
+    channels = [ramp.point(lambda v, a=a, b=b: round(a + (b - a) * v / 255))
+                for a, b in zip(top, bottom)]
+    column = Image.merge("RGB", channels).convert("RGBA")
+    return column.resize((width, height), Image.Resampling.NEAREST)
+
+def effect_magic(img, preset="magic"):
+    """Enhance brightness, contrast and sharpness over a soft gradient"""
+    img = img.convert("RGBA")
+    gradient = make_gradient(img.size, *GRADIENT_PRESETS[preset])
+    alpha = img.getchannel("A")
+    bbox = alpha.getbbox()
+    if bbox is None:
+        return gradient
+
+    # Same maths as ImageEnhance Brightness(1.2), Contrast(1.3) and Sharpness(1.5),
+    # done as lookup tables and only over the visible subject
+    brighten = [min(255, round(v * 1.2)) for v in range(256)]
+    preview = img.convert("RGB").reduce(4) if min(img.size) >= 64 else img.convert("RGB")
+    mean = int(ImageStat.Stat(preview.point(brighten * 3).convert("L")).mean[0] + 0.5)
+    contrast = [max(0, min(255, round(mean + (v - mean) * 1.3))) for v in brighten]
+
+    subject = img.crop(bbox).convert("RGB").point(contrast * 3)
+    # ImageFilter.SMOOTH is 9/13 of a 3x3 box blur plus 4/13 of the pixel itself,
+    # so blending against a box blur gives the same sharpening much faster
+    subject = Image.blend(subject.filter(ImageFilter.BoxBlur(1)), subject, 1 + 4.5 / 13)
+
+    gradient.paste(subject, bbox[:2], alpha.crop(bbox))
+    return gradient
+
+def filter_image(img, image_filter, premultiplied=False):
+    """Apply an ImageFilter; with premultiplied set, RGBA is filtered as RGBa
+
+    A cutout's transparent pixels are black, and filtering straight alpha
+    mixes that black into the soft edge, which then shows as a dark halo
+    on a light background. Premultiplied pixels carry no colour where they
+    are transparent, so the edge keeps the subject's colour.
+    """
+    if premultiplied and img.mode == "RGBA":
+        return img.convert("RGBa").filter(image_filter).convert("RGBA")
+    return img.filter(image_filter)
+
+def effect_blur(img, radius=5, scale=1.0, premultiplied=False):
+    """Gaussian blur, with the radius scaled for reduced-size previews"""
+    return filter_image(img, ImageFilter.GaussianBlur(radius=float(radius) * scale),
+                        premultiplied)
+
+def effect_sharpen(img, premultiplied=False):
+    """Sharpen filter"""
+    return filter_image(img, ImageFilter.SHARPEN, premultiplied)
+
+def effect_grayscale(img):
+    """Grayscale, keeping the alpha channel"""
+    gray = ImageOps.grayscale(img).convert("RGBA")
+    if img.mode == "RGBA":
+        gray.putalpha(img.getchannel("A"))
+    return gray
+
+def effect_bg_color(img, color):
+    """Place the image over a solid color"""
+    return composite(img, Image.new("RGBA", img.size, color))
+
+def effect_bg_image(img, bg_path, fit="cover"):
+    """Place the image over another image, cover-fitted to the same size"""
+    return composite(img, BACKGROUNDS.get(bg_path, img.size, fit))
+
+EFFECTS = {
+    "magic": effect_magic,
+    "blur": effect_blur,
+    "sharpen": effect_sharpen,
+    "grayscale": effect_grayscale,
+    "bgcolor": effect_bg_color,
+    "bgimage": effect_bg_image,
+}
+
+def parse_effect(spec):
+    """Parse 'name' or 'name:arg' into an (name, args) effect step"""
+    name, _, arg = spec.partition(":")
+    name = name.strip().lower()
+    if name not in EFFECTS:
+        raise ValueError(f"Unknown effect '{name}' (choose from {', '.join(EFFECTS)})")
+    # Check arguments here so a bad spec fails once, not for every image
+    if name == "magic" and arg and arg not in GRADIENT_PRESETS:
+        raise ValueError(f"Unknown magic preset '{arg}' (choose from {', '.join(GRADIENT_PRESETS)})")
+    if name == "blur" and arg:
+        try:
+            float(arg)
+        except ValueError:
+            raise ValueError(f"blur radius must be a number, not '{arg}'") from None
+    if name in ("sharpen", "grayscale") and arg:
+        raise ValueError(f"{name} takes no argument")
+    if name in ("bgcolor", "bgimage") and not arg:
+        raise ValueError(f"{name} needs an argument ({name}:VALUE)")
+    if name == "bgcolor":
+        try:
+            ImageColor.getrgb(arg)
+        except ValueError:
+            raise ValueError(f"Unknown color '{arg}'") from None
+    return (name, (arg,) if arg else ())
+
+# Effects whose parameters are measured in pixels of the full-size image
+SCALED_EFFECTS = {"blur"}
+# Effects that filter neighbouring pixels and can do so with premultiplied alpha
+FILTER_EFFECTS = {"blur", "sharpen"}
+
+def apply_effects(img, effects, scale=1.0, premultiplied=False):
+    """Apply a sequence of (name, args) effect steps in order"""
+    for name, args in effects:
+        options = {}
+        if name in SCALED_EFFECTS:
+            options["scale"] = scale
+        if name in FILTER_EFFECTS:
+            options["premultiplied"] = premultiplied
+        img = EFFECTS[name](img, *args, **options)
+    return img
+
+def fit_size(size, box):
+    """Largest size with the same aspect ratio that fits inside box"""
+    scale = min(box[0] / size[0], box[1] / size[1], 1.0)
+    return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+
+def image_bytes(img):
+    """Approximate memory held by an image's pixel data"""
+    return img.width * img.height * len(img.getbands())
+
+class EffectChain:
+    """Effect steps recorded against a base image and rendered on demand
+
+    Previews are rendered on a display-sized proxy of the base so edits are
+    instant; the full resolution result is only rendered when it is needed.
+    """
+
+    CHECKPOINT_EVERY = 4
+
+    def __init__(self, base, proxy_size=(400, 400)):
+        self.base = base
+        self.steps = []
+        # Resize straight from the base; a full-size copy would double peak memory
+        self.proxy_base = base.resize(fit_size(base.size, proxy_size),
+                                      Image.Resampling.LANCZOS, reducing_gap=3.0)
+        self.proxy_scale = self.proxy_base.width / base.width
+        self._checkpoints = OrderedDict()
+        self._last = None
+        self._full = None
+        self._lock = threading.Lock()
+
+    def render_proxy(self, steps=None):
+        """Render the steps on the proxy, starting from the nearest checkpoint"""
+        steps = tuple(self.steps if steps is None else steps)
+        # Renders run on worker threads while the Tk thread measures and trims
+        # the caches, so they are only touched under the lock
+        with self._lock:
+            if self._last is not None and self._last[0] == steps:
+                return self._last[1]
+            start, img = 0, self.proxy_base
+            for i in range(len(steps), 0, -1):
+                checkpoint = self._checkpoints.get(steps[:i])
+                if checkpoint is not None:
+                    start, img = i, checkpoint
+                    break
+        for i in range(start, len(steps)):
+            img = apply_effects(img, [steps[i]], self.proxy_scale)
+            if (i + 1) % self.CHECKPOINT_EVERY == 0:
+                with self._lock:
+                    self._checkpoints[steps[:i + 1]] = img
+        with self._lock:
+            self._last = (steps, img)
+        return img
+
+    def render_full(self, steps=None):
+        """Render the steps at full resolution, cached until the steps change"""
+        steps = tuple(self.steps if steps is None else steps)
+        with self._lock:
+            if self._full is not None and self._full[0] == steps:
+                return self._full[1]
+        img = apply_effects(self.base, steps)
+        with self._lock:
+            self._full = (steps, img)
+        return img
+
+    def cache_bytes(self):
+        """Memory held by cached renders (not the base image itself)"""
+        with self._lock:
+            total = sum(image_bytes(img) for img in self._checkpoints.values())
+            for cached in (self._last, self._full):
+                if cached is not None:
+                    total += image_bytes(cached[1])
+        return total
+
+    def drop_cached(self):
+        """Free one cached render, the full-size one first; False if none are left"""
+        with self._lock:
+            if self._full is not None:
+                self._full = None
+                return True
+            if self._checkpoints:
+                self._checkpoints.popitem(last=False)
+                return True
+        return False
+
+class EditHistory:
+    """Undo/redo log of effect steps applied to one chain, within a memory budget
+
+    States are stored as step tuples rather than images; the chain keeps a
+    rendered checkpoint every few steps so undo only re-renders a short tail
+    at preview resolution. When the budget is exceeded cached renders are
+    dropped first, then the oldest states.
+    """
+
+    STATE_BYTES = 256
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.chain = None
+        self._states = []
+        self._position = -1
+
+    def reset(self, chain):
+        """Start a new log for a new base image, or an empty one for None"""
+        self.chain = chain
+        self._states = [tuple(chain.steps)] if chain else []
+        self._position = 0 if chain else -1
+
+    def record(self):
+        """Record the chain's current steps as the newest state"""
+        del self._states[self._position + 1:]
+        self._states.append(tuple(self.chain.steps))
+        self._position += 1
+        self.enforce_budget()
+
+    def can_undo(self):
+        return self._position > 0
+
+    def can_redo(self):
+        return self._position < len(self._states) - 1
+
+    def undo(self):
+        """Step back and return the restored steps, or None"""
+        if not self.can_undo():
+            return None
+        self._position -= 1
+        return self._states[self._position]
+
+    def redo(self):
+        """Step forward and return the restored steps, or None"""
+        if not self.can_redo():
+            return None
+        self._position += 1
+        return self._states[self._position]
+
+    def memory_bytes(self):
+        """Memory attributed to history: cached renders plus the step log"""
+        cached = self.chain.cache_bytes() if self.chain else 0
+        return cached + len(self._states) * self.STATE_BYTES
+
+    def enforce_budget(self):
+        while self.memory_bytes() > self.max_bytes:
+            if self.chain.drop_cached():
+                continue
+            if self._position > 0:
+                self._states.pop(0)
+                self._position -= 1
+                continue
+            break
+
+def save_image(img, path, file_format="PNG", **options):
+    """Save an image, flattening transparency for formats without alpha"""
+    if file_format == "JPEG" and img.mode == "RGBA":
+        rgb_img = Image.new("RGB", img.size, (255, 255, 255))
+        rgb_img.paste(img, mask=img.split()[3])
+        img = rgb_img
+    img.save(path, file_format, **options)
+
+# ----------------- OUTPUT -------------------------
+
+# What gets written: the cutout, its mask as 8-bit grayscale, or a 1-bit mask
+OUTPUT_KINDS = ("cutout", "mask", "mask1")
+JPEG_SUBSAMPLING = ("4:4:4", "4:2:2", "4:2:0")
+
+class Encoder:
+    """Encoder settings and the kind of output written for each result
+
+    Masks are always written as PNG, and crop trims every output to the
+    subject's bounding box. premultiplied runs the blur and sharpen effects
+    on premultiplied alpha. The defaults match Pillow's own.
+    """
+
+    def __init__(self, file_format="PNG", kind="cutout", crop=False, png_compress_level=6,
+                 webp_quality=80, webp_lossless=False, webp_method=4,
+                 jpeg_quality=75, jpeg_subsampling="4:2:0", premultiplied=False):
+        if kind not in OUTPUT_KINDS:
+            raise ValueError(f"output must be one of {', '.join(OUTPUT_KINDS)}")
+        if jpeg_subsampling not in JPEG_SUBSAMPLING:
+            raise ValueError(f"JPEG subsampling must be one of {', '.join(JPEG_SUBSAMPLING)}")
+        self.file_format = file_format if kind == "cutout" else "PNG"
+        self.kind = kind
+        self.crop = crop
+        self.png_compress_level = png_compress_level
+        self.webp_quality = webp_quality
+        self.webp_lossless = webp_lossless
+        self.webp_method = webp_method
+        self.jpeg_quality = jpeg_quality
+        self.jpeg_subsampling = jpeg_subsampling
+        self.premultiplied = premultiplied
+
+    def copy(self, **changes):
+        """The same encoder with some settings changed"""
+        return Encoder(**dict(vars(self), **changes))
+
+    @property
+    def suffix(self):
+        return "nobg" if self.kind == "cutout" else "mask"
+
+    def options(self, file_format=None):
+        """Keyword arguments for Image.save"""
+        file_format = file_format or self.file_format
+        if file_format == "PNG":
+            return {"compress_level": self.png_compress_level}
+        if file_format == "WEBP":
+            return {"quality": self.webp_quality, "lossless": self.webp_lossless,
+                    "method": self.webp_method}
+        if file_format == "JPEG":
+            return {"quality": self.jpeg_quality, "subsampling": self.jpeg_subsampling}
+        return {}
+
+    def mask_image(self, alpha):
+        if self.kind == "mask1":
+            return alpha.point(lambda v: 255 if v >= 128 else 0, "1")
+        return alpha
+
+    def prepare(self, cutout, effects=(), result=None):
+        """Return the image to write for a plain cutout
+
+        result is the cutout with the effects already applied, when the
+        caller has it rendered.
+        """
+        alpha = cutout.getchannel("A")
+        if self.kind == "cutout":
+            img = result if result is not None else \
+                apply_effects(cutout, effects, premultiplied=self.premultiplied)
+        else:
+            img = self.mask_image(alpha)
+        if self.crop:
+            bbox = alpha.getbbox()
+            if bbox:
+                img = img.crop(bbox)
+        return img
+
+    def prepare_frames(self, frames, effects=()):
+        """Like prepare for (cutout, duration) animation frames
+
+        Animated masks stay 8-bit, and cropping uses the box that holds the
+        subject in every frame so the frames stay aligned.
+        """
+        if self.kind == "cutout":
+            results = effect_frames(frames, effects, self.premultiplied)
+        else:
+            results = ((frame.getchannel("A"), duration) for frame, duration in frames)
+        if not self.crop:
+            return results
+        boxes = [box for box in (frame.getchannel("A").getbbox() for frame, _ in frames) if box]
+        if not boxes:
+            return results
+        bbox = (min(b[0] for b in boxes), min(b[1] for b in boxes),
+                max(b[2] for b in boxes), max(b[3] for b in boxes))
+        return ((img.crop(bbox), duration) for img, duration in results)
+
+    def save(self, img, path, file_format=None):
+        file_format = file_format or self.file_format
+        save_image(img, path, file_format, **self.options(file_format))
+
+# ----------------- ANIMATION -------------------------
+
+ANIMATION_FORMATS = ("PNG", "WEBP")
+# Mean absolute difference (0-255) between small grayscale copies of two
+# frames below which the earlier frame's mask is reused
+FRAME_REUSE_THRESHOLD = 2.0
+DEFAULT_FRAME_DURATION = 100
+
+def open_image(data):
+    """Open image bytes lazily, keeping every frame of animated files"""
+    try:
+        return Image.open(io.BytesIO(data))
+    except UnidentifiedImageError:
+        raise ValueError("not a recognised image file") from None
+
+def is_animated(img):
+    return getattr(img, "n_frames", 1) > 1
+
+def animation_format(file_format, source):
+    """Output format for an animated source: multi-page TIFF stays TIFF"""
+    if source.format == "TIFF":
+        return "TIFF"
+    return file_format if file_format in ANIMATION_FORMATS else "WEBP"
+
+def iter_frames(img):
+    """Yield (RGBA frame, duration in ms), decoding one frame at a time"""
+    for index in range(img.n_frames):
+        img.seek(index)
+        frame = img.convert("RGBA")
+        # Some decoders (WEBP) only fill in the duration once the frame is loaded
+        yield frame, img.info.get("duration") or DEFAULT_FRAME_DURATION
+
+def frame_signature(frame):
+    return frame.convert("L").resize((64, 64), Image.Resampling.BILINEAR)
+
+def cutout_frames(img, session, effects=(), stats=None):
+    """Cut out every frame of an animation, yielding (result, duration)
+
+    Frames identical to an earlier one reuse its result, and a frame that
+    barely differs from the last segmented frame reuses that frame's mask
+    instead of running inference again.
+    """
+    stats = stats if stats is not None else {}
+    for name in ("frames", "duplicates", "reused", "inferred"):
+        stats.setdefault(name, 0)
+    results = {}
+    key_signature = key_mask = None
+    for frame, duration in iter_frames(img):
+        stats["frames"] += 1
+        digest = hashlib.blake2b(frame.tobytes(), digest_size=16).digest()
+        if digest in results:
+            stats["duplicates"] += 1
+            yield results[digest], duration
+            continue
+        signature = frame_signature(frame)
+        if key_mask is not None and ImageStat.Stat(
+                ImageChops.difference(signature, key_signature)).mean[0] < FRAME_REUSE_THRESHOLD:
+            stats["reused"] += 1
+            mask = key_mask
+        else:
+            stats["inferred"] += 1
+            mask = predict_mask(frame.convert("RGB"), session)
+            key_signature, key_mask = signature, mask
+        result = apply_effects(apply_mask(frame, mask), effects)
+        results[digest] = result
+        yield result, duration
+
+def effect_frames(frames, effects, premultiplied=False):
+    """Apply effects to (frame, duration) pairs, once per distinct frame"""
+    rendered = {}
+    for frame, duration in frames:
+        if id(frame) not in rendered:
+            rendered[id(frame)] = apply_effects(frame, effects, premultiplied=premultiplied)
+        yield rendered[id(frame)], duration
+
+def save_animation(frames, path, file_format="PNG", loop=0, **options):
+    """Encode (frame, duration) pairs as an animated PNG/WEBP or multi-page TIFF
+
+    The encoders need the whole sequence, so only the processed frames are
+    collected here; source frames are never all decoded at once.
+    """
+    images, durations = [], []
+    for frame, duration in frames:
+        images.append(frame)
+        durations.append(duration)
+    if not images:
+        raise ValueError("animation has no frames")
+    options.update(save_all=True, append_images=images[1:])
+    if file_format != "TIFF":
+        options.update(duration=durations, loop=loop)
+    if file_format == "PNG" and images[0].mode == "RGBA":
+        # Clear each frame before drawing the next so transparent areas stay clear
+        options["disposal"] = 1
+    images[0].save(path, file_format, **options)
+
+# ----------------- BATCH ENGINE -------------------------
+
+class BatchManifest:
+    """Per output folder record of batch inputs, so re-runs only redo what changed
+
+    Each input gets an entry with its content hash, the settings it was
+    processed with, the output it produced and whether that succeeded.
+    Entries are appended as JSON lines while the batch runs, so a crash
+    loses at most the file in progress, and compacted when the run ends.
+    """
+
+    FILENAME = ".bgremover-manifest.jsonl"
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, self.FILENAME)
+        self.entries = {}
+        # Normalized output path -> the source whose result it holds
+        self.owners = {}
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by a crash
+                    self._store(entry)
+        except FileNotFoundError:
+            pass
+        self._log = open(self.path, "a")
+
+    @staticmethod
+    def _output_key(output):
+        return os.path.normcase(os.path.abspath(output))
+
+    def _store(self, entry):
+        """Keep entry as the latest for its source and update the output owners"""
+        previous = self.entries.get(entry["source"])
+        if previous is not None and previous["output"]:
+            key = self._output_key(previous["output"])
+            if self.owners.get(key) == entry["source"]:
+                del self.owners[key]
+        self.entries[entry["source"]] = entry
+        if entry["status"] == "done" and entry["output"]:
+            self.owners[self._output_key(entry["output"])] = entry["source"]
+
+    def is_current(self, path, settings, digest=None):
+        """True if path was already processed with these settings and its output exists
+
+        Without a digest an unchanged size and modification time is enough;
+        with one the content hash has to match.
+        """
+        entry = self.entries.get(os.path.abspath(path))
+        if (entry is None or entry["status"] != "done" or entry["settings"] != settings
+                or not os.path.exists(entry["output"])):
+            return False
+        if digest is not None:
+            return entry["hash"] == digest
+        stat = os.stat(path)
+        return [entry["bytes"], entry["mtime_ns"]] == [stat.st_size, stat.st_mtime_ns]
+
+    def claimed_by(self, output, path):
+        """Another input still on disk whose recorded output is output, or None"""
+        with self._lock:
+            owner = self.owners.get(self._output_key(output))
+        if owner is None or owner == os.path.abspath(path) or not os.path.exists(owner):
+            return None
+        return owner
+
+    def record(self, path, settings, digest, output=None, error=None):
+        """Record the outcome for one input"""
+        try:
+            stat = os.stat(path)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        except OSError:
+            size = mtime_ns = None  # removed while it was being processed
+        entry = {"source": os.path.abspath(path), "hash": digest, "bytes": size,
+                 "mtime_ns": mtime_ns, "settings": settings, "output": output,
+                 "status": "failed" if error else "done", "error": error, "time": time.time()}
+        with self._lock:
+            self._store(entry)
+            self._log.write(json.dumps(entry) + "\n")
+            self._log.flush()
+
+    def close(self):
+        """Rewrite the manifest with one line per input"""
+        with self._lock:
+            self._log.close()
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(tmp, self.path)
+
+class BatchEngine:
+    """Remove backgrounds from many files with overlapping decode, inference and encode"""
+
+    def __init__(self, sessions, workers=None, queue_size=None, output_format="PNG",
+                 effects=(), cache=None, tracer=None, encoder=None, writers=None, resume=True):
+        self.sessions = sessions
+        self.cache = cache
+        self.tracer = tracer or Tracer()
+        self.workers = workers or max(1, min(4, (os.cpu_count() or 2) // 2))
+        if workers is None and sessions.max_batch > 1:
+            # Enough concurrent callers to actually fill a batch
+            self.workers = max(self.workers, sessions.max_batch)
+        self.queue_size = queue_size or self.workers * 2
+        # Encoding (zlib for PNG) releases the GIL, so writers run in parallel
+        self.writers = writers or max(2, min(4, (os.cpu_count() or 2) // 2))
+        self.encoder = encoder or Encoder(output_format)
+        self.output_format = self.encoder.file_format
+        self.effects = list(effects)
+        self.resume = resume
+        self._worker_sessions = {}
+        self._session_lock = threading.Lock()
+
+    def output_path_for(self, path, output_dir, file_format=None, stem=None):
+        """Return the output file written for an input path"""
+        filename = stem or os.path.splitext(os.path.basename(path))[0]
+        file_format = file_format or self.output_format
+        return os.path.join(output_dir,
+                            f"{filename}_{self.encoder.suffix}.{file_format.lower()}")
+
+    @staticmethod
+    def output_stems(paths):
+        """Output name stems for a run, and the inputs whose outputs would clash
+
+        Inputs sharing a name stem (photo.jpg, photo.png) keep their
+        extension in it (photo_jpg, photo_png). Any that still clash, like
+        the same file name in two folders, are returned as {path: earlier
+        path} instead of a stem.
+        """
+        counts = Counter(os.path.splitext(os.path.basename(p))[0].lower() for p in paths)
+        stems, clashes, owners = {}, {}, {}
+        for path in paths:
+            name, ext = os.path.splitext(os.path.basename(path))
+            if counts[name.lower()] > 1 and ext:
+                name = f"{name}_{ext[1:].lower()}"
+            owner = owners.setdefault(name.lower(), path)
+            if owner != path:
+                clashes[path] = owner
+            else:
+                stems[path] = name
+        return stems, clashes
+
+    def worker_session(self, index):
+        """Return the session for a worker, kept alive between runs
+
+        With micro-batching enabled every worker shares the batching
+        scheduler instead of owning a session.
+        """
+        if index == 0 or self.sessions.max_batch > 1:
+            return self.sessions.predictor()
+        with self._session_lock:
+            if index not in self._worker_sessions:
+                threads = max(1, (os.cpu_count() or 1) // self.workers)
+                self._worker_sessions[index] = self.sessions.create_session(threads)
+            return self._worker_sessions[index]
+
+    def run_settings(self, effects):
+        """Everything that changes the output, as the manifest stores it"""
+        settings = {"model": self.sessions.settings(), "encoder": vars(self.encoder),
+                    "effects": effects}
+        return json.loads(json.dumps(settings))
+
+    def run(self, paths, output_dir, on_progress=None, effects=None, cancelled=None):
+        """Process every path and return (processed, skipped, failed) lists
+
+        on_progress(done, total, path, error, skipped) is called from worker
+        threads after each file, so GUI callers must marshal it onto the Tk
+        thread. effects overrides the engine's effect steps for this run.
+        With resume enabled, inputs whose outputs in output_dir are current
+        according to the manifest there are skipped. Once cancelled()
+        returns true the run stops after the files in progress; the rest
+        are left out of the returned lists.
+        """
+        cancelled = cancelled or (lambda: False)
+        effects = self.effects if effects is None else list(effects)
+        # An input listed twice is processed once
+        paths = list(dict.fromkeys(paths))
+        stems, clashes = self.output_stems(paths)
+        total = len(paths)
+        processed = []
+        skipped = []
+        failed = []
+        lock = threading.Lock()
+        decoded = queue.Queue(maxsize=self.queue_size)
+        finished = queue.Queue(maxsize=self.queue_size)
+        run_settings = self.run_settings(effects)
+        manifest = BatchManifest(output_dir) if self.resume else None
+        digests = {}
+
+        def report(path, error=None, output=None, skip=False):
+            if manifest and not skip and path in digests:
+                manifest.record(path, run_settings, digests[path], output,
+                                None if error is None else str(error))
+            with lock:
+                if skip:
+                    skipped.append(path)
+                elif error is None:
+                    processed.append(path)
+                else:
+                    failed.append((path, str(error)))
+                done = len(processed) + len(skipped) + len(failed)
+            if on_progress:
+                on_progress(done, total, path, error, skip)
+
+        settings = self.sessions.settings()
+
+        def read_stage():
+            for path in paths:
+                if cancelled():
+                    break
+                if path in clashes:
+                    report(path, ValueError(f"its output name clashes with {clashes[path]}"))
+                    continue
+                try:
+                    if manifest and manifest.is_current(path, run_settings):
+                        report(path, skip=True)
+                        continue
+                    with self.tracer.span("batch.read", path=path) as info:
+                        with open(path, 'rb') as f:
+                            data = f.read()
+                        digests[path] = hashlib.sha256(data).hexdigest()
+                        if manifest and manifest.is_current(path, run_settings, digests[path]):
+                            # Touched but not changed: refresh the size and time on record
+                            entry = manifest.entries[os.path.abspath(path)]
+                            manifest.record(path, run_settings, digests[path], entry["output"])
+                            report(path, skip=True)
+                            continue
+                        img = open_image(data)
+                        info["size"] = img.size
+                        if is_animated(img):
+                            # Frames are decoded lazily by the worker that segments them
+                            info["frames"] = img.n_frames
+                            decoded.put((path, img, None, None))
+                            continue
+                        img = decode_image(data)
+                        key = self.cache.key(data, settings) if self.cache else None
+                        mask = self.cache.get(key) if self.cache else None
+                except Exception as e:
+                    report(path, e)
+                    continue
+                if mask is not None and mask.size != img.size:
+                    mask = None
+                decoded.put((path, img, mask, key))
+            for _ in range(self.workers):
+                decoded.put(None)
+
+        def infer_stage(index):
+            try:
+                session = self.worker_session(index)
+            except Exception as e:
+                session = None
+                session_error = e
+            while True:
+                item = decoded.get()
+                if item is None:
+                    break
+                if cancelled():
+                    continue  # drain the queue so the reader can finish
+                path, img, mask, key = item
+                if is_animated(img):
+                    try:
+                        with self.tracer.span("batch.infer", path=path, size=img.size) as info:
+                            if session is None:
+                                raise session_error
+                            # Effects are applied by the writers, like for still images
+                            frames = list(cutout_frames(img, session, stats=info))
+                    except Exception as e:
+                        report(path, e)
+                        continue
+                    finished.put((path, frames, (animation_format(self.output_format, img),
+                                                 img.info.get("loop", 0))))
+                    continue
+                try:
+                    with self.tracer.span("batch.infer", path=path, size=img.size,
+                                          cached=mask is not None):
+                        if mask is None:
+                            if session is None:
+                                raise session_error
+                            mask = predict_mask(img, session)
+                            if self.cache:
+                                self.cache.put(key, mask)
+                        cutout = apply_mask(img, mask)
+                except Exception as e:
+                    report(path, e)
+                    continue
+                finished.put((path, cutout, None))
+
+        def write_stage():
+            while True:
+                item = finished.get()
+                if item is None:
+                    break
+                path, cutout, animation = item
+                try:
+                    file_format = animation[0] if animation else None
+                    output = self.output_path_for(path, output_dir, file_format, stems[path])
+                    owner = manifest.claimed_by(output, path) if manifest else None
+                    if owner:
+                        raise ValueError(f"{os.path.basename(output)} already holds the "
+                                         f"result for {owner}")
+                    if animation:
+                        file_format, loop = animation
+                        with self.tracer.span("batch.write", path=path, frames=len(cutout)):
+                            save_animation(self.encoder.prepare_frames(cutout, effects), output,
+                                           file_format, loop, **self.encoder.options(file_format))
+                    else:
+                        with self.tracer.span("batch.write", path=path, size=cutout.size):
+                            result = self.encoder.prepare(cutout, effects)
+                            self.encoder.save(result, output)
+                except Exception as e:
+                    report(path, e)
+                    continue
+                report(path, output=output)
+
+        try:
+            reader = threading.Thread(target=read_stage, daemon=True)
+            inferers = [threading.Thread(target=infer_stage, args=(i,), daemon=True)
+                        for i in range(self.workers)]
+            writers = [threading.Thread(target=write_stage, daemon=True)
+                       for _ in range(self.writers)]
+            for thread in [reader] + inferers + writers:
+                thread.start()
+
+            reader.join()
+            for thread in inferers:
+                thread.join()
+            for _ in writers:
+                finished.put(None)
+            for thread in writers:
+                thread.join()
+        finally:
+            if manifest:
+                manifest.close()
+        return processed, skipped, failed
+
+# ----------------- HTTP SERVICE -------------------------
+
+class RemovalService:
+    """Local HTTP background removal on one warm model with bounded concurrency
+
+    POST /remove with the image as the request body; query parameters pick
+    the output format (format=PNG|WEBP|JPEG), effects (effect=blur:3, may
+    repeat), what to return (output=cutout|mask|mask1), whether to crop to
+    the subject (crop=1) and the speed/quality tier (tier=fast|balanced|
+    quality). GET /health and GET /metrics report status as JSON. Requests
+    beyond the concurrency limit wait in a bounded queue; when that is full
+    the service answers 429 instead of piling up work.
+    """
+
+    MAX_BODY_BYTES = 64 * 1024 * 1024
+    CHUNK_SIZE = 64 * 1024
+    READ_TIMEOUT = 30
+    FORMATS = {"PNG": "image/png", "WEBP": "image/webp", "JPEG": "image/jpeg"}
+
+    def __init__(self, sessions, cache=None, tracer=None, concurrency=2, queue_size=8,
+                 encoder=None):
+        self.sessions = sessions
+        self.encoder = encoder or Encoder()
+        self.cache = cache
+        self.tracer = tracer or Tracer()
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.metrics = {"requests": 0, "completed": 0, "rejected": 0, "failed": 0,
+                        "in_flight": 0, "waiting": 0, "processing_seconds": 0.0}
+        self._slots = None
+
+    def process(self, data, effects, encoder, sessions=None):
+        """Remove the background and encode it, returning (body, format) (runs on a worker thread)"""
+        sessions = sessions or self.sessions
+        with self.tracer.span("service.request", bytes=len(data)) as info:
+            img = open_image(data)
+            info["size"] = img.size
+            buf = io.BytesIO()
+            if is_animated(img):
+                # Multi-page TIFFs come back as animated WEBP too; TIFF isn't served
+                file_format = encoder.file_format
+                if file_format not in ANIMATION_FORMATS:
+                    file_format = "WEBP"
+                frames = list(cutout_frames(img, sessions.predictor(), stats=info))
+                save_animation(encoder.prepare_frames(frames, effects), buf, file_format,
+                               img.info.get("loop", 0), **encoder.options(file_format))
+                return buf.getvalue(), file_format
+            img = decode_image(data)
+            mask = compute_mask(data, img, sessions.predictor(),
+                                sessions.settings(), self.cache)
+            encoder.save(encoder.prepare(apply_mask(img, mask), effects), buf)
+            return buf.getvalue(), encoder.file_format
+
+    async def read_request(self, reader):
+        """Parse a request into (method, path, query, body); None if the client went away"""
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length > self.MAX_BODY_BYTES:
+            raise ValueError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body = await reader.readexactly(length) if length else b""
+        url = urlsplit(target)
+        return method.upper(), url.path, parse_qs(url.query), body
+
+    async def respond(self, writer, status, body, content_type="application/json", headers=None):
+        """Send a response, streaming the body in chunks with backpressure"""
+        lines = [f"HTTP/1.1 {status.value} {status.phrase}",
+                 f"Content-Type: {content_type}",
+                 f"Content-Length: {len(body)}",
+                 "Connection: close"]
+        for name, value in (headers or {}).items():
+            lines.append(f"{name}: {value}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        for start in range(0, len(body), self.CHUNK_SIZE):
+            writer.write(body[start:start + self.CHUNK_SIZE])
+            await writer.drain()
+        await writer.drain()
+
+    async def respond_json(self, writer, status, payload, headers=None):
+        await self.respond(writer, status, json.dumps(payload).encode(), headers=headers)
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                request = await asyncio.wait_for(self.read_request(reader), self.READ_TIMEOUT)
+            except ValueError as e:
+                status = e.args[0] if e.args and isinstance(e.args[0], HTTPStatus) \
+                    else HTTPStatus.BAD_REQUEST
+                await self.respond_json(writer, status, {"error": status.phrase})
+                return
+            if request is None:
+                return
+            method, path, query, body = request
+
+            if method == "GET" and path == "/health":
+                await self.respond_json(writer, HTTPStatus.OK, {
+                    "status": "ok", "model_ready": self.sessions.is_ready()})
+            elif method == "GET" and path == "/metrics":
+                await self.respond_json(writer, HTTPStatus.OK, self.snapshot())
+            elif method == "POST" and path == "/remove":
+                await self.handle_remove(writer, query, body)
+            else:
+                await self.respond_json(writer, HTTPStatus.NOT_FOUND, {"error": "Not Found"})
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_remove(self, writer, query, body):
+        self.metrics["requests"] += 1
+        file_format = query.get("format", ["PNG"])[0].upper()
+        try:
+            if file_format not in self.FORMATS:
+                raise ValueError(f"format must be one of {', '.join(self.FORMATS)}")
+            effects = [parse_effect(spec) for spec in query.get("effect", [])]
+            if any(name == "bgimage" for name, _ in effects):
+                raise ValueError("bgimage is not available over HTTP")
+            if not body:
+                raise ValueError("request body must contain an image")
+            encoder = self.encoder.copy(
+                file_format=file_format, kind=query.get("output", ["cutout"])[0].lower(),
+                crop=query.get("crop", ["0"])[0].lower() in ("1", "true", "yes"))
+            tier = query.get("tier", [None])[0]
+            sessions = self.sessions.for_tier(tier.lower()) if tier else self.sessions
+        except ValueError as e:
+            self.metrics["failed"] += 1
+            await self.respond_json(writer, HTTPStatus.BAD_REQUEST, {"error": str(e)})
+            return
+
+        # Backpressure: everything past the running slots and the queue is turned away
+        if self.metrics["in_flight"] + self.metrics["waiting"] >= self.concurrency + self.queue_size:
+            self.metrics["rejected"] += 1
+            await self.respond_json(writer, HTTPStatus.TOO_MANY_REQUESTS,
+                                    {"error": "queue full"}, headers={"Retry-After": "1"})
+            return
+
+        self.metrics["waiting"] += 1
+        async with self._slots:
+            self.metrics["waiting"] -= 1
+            self.metrics["in_flight"] += 1
+            start = time.perf_counter()
+            try:
+                loop = asyncio.get_running_loop()
+                result, file_format = await loop.run_in_executor(
+                    self.executor, self.process, body, effects, encoder, sessions)
+            except Exception as e:
+                self.metrics["failed"] += 1
+                await self.respond_json(writer, HTTPStatus.UNPROCESSABLE_ENTITY, {"error": str(e)})
+                return
+            finally:
+                self.metrics["in_flight"] -= 1
+                self.metrics["processing_seconds"] += time.perf_counter() - start
+        self.metrics["completed"] += 1
+        await self.respond(writer, HTTPStatus.OK, result, self.FORMATS[file_format])
+
+    def snapshot(self):
+        """Current counters plus derived figures for /metrics"""
+        metrics = dict(self.metrics)
+        done = metrics["completed"]
+        metrics["mean_seconds"] = metrics["processing_seconds"] / done if done else 0.0
+        metrics["concurrency"] = self.concurrency
+        metrics["queue_size"] = self.queue_size
+        if self.cache:
+            metrics["cache_hits"] = self.cache.hits
+            metrics["cache_misses"] = self.cache.misses
+        return metrics
+
+    async def serve(self, host="127.0.0.1", port=8765, ready=None):
+        """Serve until cancelled; ready(server) is called once the socket is listening"""
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self.sessions.warm_up()
+        server = await asyncio.start_server(self.handle, host, port)
+        if ready:
+            ready(server)
+        async with server:
+            await server.serve_forever()
+
+# ----------------- VIEWER -------------------------
+
+# Side of the square tiles the image views draw, in screen pixels
+VIEW_TILE_SIZE = 256
+# Largest zoom, in screen pixels per image pixel
+MAX_ZOOM = 16.0
+ZOOM_STEP = 1.25
+
+class ImagePyramid:
+    """An image and its successive half-size reductions, built once
+
+    Views draw each tile from the smallest level that still has at least
+    the zoomed resolution, so zooming and panning never resample the full
+    image. size is the image's logical size, which a reduced preview can
+    stand in for until the full image is decoded.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, img, size=None, min_side=VIEW_TILE_SIZE):
+        self.id = next(self._ids)
+        self.size = tuple(size or img.size)
+        # reduce() fails on palette, bilevel and 16-bit images, and Tk shows
+        # only L, RGB and RGBA directly
+        if img.mode not in ("RGB", "RGBA", "L"):
+            img = img.convert("RGBA")
+        self.levels = [img]
+        while max(self.levels[-1].size) > min_side:
+            self.levels.append(self.levels[-1].reduce(2))
+
+    def scale(self, level):
+        """Level pixels per logical image pixel"""
+        return self.levels[level].width / self.size[0]
+
+    def level_for(self, zoom):
+        """The smallest level with at least zoom pixels per image pixel"""
+        level = 0
+        while level + 1 < len(self.levels) and self.scale(level + 1) >= zoom:
+            level += 1
+        return level
+
+    def tile(self, col, row, zoom, tile_size=VIEW_TILE_SIZE):
+        """Render one screen tile of the image at zoom"""
+        level = self.level_for(zoom)
+        img = self.levels[level]
+        width, height = (max(1, round(side * zoom)) for side in self.size)
+        box = (col * tile_size, row * tile_size,
+               min((col + 1) * tile_size, width), min((row + 1) * tile_size, height))
+        factor = self.scale(level) / zoom
+        source = (box[0] * factor, box[1] * factor,
+                  min(box[2] * factor, img.width), min(box[3] * factor, img.height))
+        # Past 2x, show the actual pixels so cutout edges can be inspected
+        resample = Image.Resampling.NEAREST if factor <= 0.5 else Image.Resampling.BILINEAR
+        return img.resize((box[2] - box[0], box[3] - box[1]), resample, box=source)
+
+class TileCache:
+    """Rendered view tiles by (pyramid, zoom, column, row), evicted least
+    recently used first to stay within max_bytes"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def get(self, pyramid, col, row, zoom, make):
+        key = (pyramid.id, zoom, col, row)
+        photo = self._entries.get(key)
+        if photo is not None:
+            self._entries.move_to_end(key)
+            return photo
+        photo = make()
+        self._entries[key] = photo
+        self._bytes += photo.width() * photo.height() * 4
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, old = self._entries.popitem(last=False)
+            self._bytes -= old.width() * old.height() * 4
+        return photo
+
+class ImageView:
+    """A canvas that shows an image pyramid with zoom and pan
+
+    The view is kept as a zoom (screen pixels per image pixel, or None to
+    fit the canvas) and the image point at the canvas centre as fractions
+    of the image size, so linked views of the same image stay in step.
+    Only the tiles inside the canvas are drawn. When the user zooms past
+    the resolution of the pyramid shown, on_detail() is called once so a
+    sharper one can be built.
+    """
+
+    def __init__(self, canvas, tiles, tile_size=VIEW_TILE_SIZE, on_detail=None):
+        self.canvas = canvas
+        self.tiles = tiles
+        self.tile_size = tile_size
+        self.on_detail = on_detail
+        self.pyramid = None
+        self.zoom = None
+        self.center = (0.5, 0.5)
+        self.linked = []
+        # Photos drawn right now, kept alive even if the cache evicts them
+        self._drawn = []
+        self._detail_requested = None
+        self._drag = None
+        self._redraw_pending = False
+        canvas.bind("<Configure>", lambda e: self.schedule_redraw())
+        canvas.bind("<ButtonPress-1>", self._start_pan)
+        canvas.bind("<B1-Motion>", self._pan)
+        canvas.bind("<Double-Button-1>", lambda e: self.set_view(None, (0.5, 0.5)))
+        canvas.bind("<MouseWheel>", lambda e: self._wheel(e, e.delta > 0))
+        canvas.bind("<Button-4>", lambda e: self._wheel(e, True))
+        canvas.bind("<Button-5>", lambda e: self._wheel(e, False))
+
+    def link(self, other):
+        """Keep zoom and pan of this view and other in step"""
+        self.linked.append(other)
+        other.linked.append(self)
+
+    def show(self, pyramid, keep_view=False):
+        """Display a pyramid, fitted to the canvas unless keep_view is set"""
+        self.pyramid = pyramid
+        if keep_view:
+            self.redraw()
+        else:
+            self.set_view(None, (0.5, 0.5))
+
+    def clear(self):
+        """Remove the image from the canvas"""
+        self.pyramid = None
+        self._drawn = []
+        self.canvas.delete("all")
+
+    def canvas_size(self):
+        return (self.canvas.winfo_width() or 400, self.canvas.winfo_height() or 400)
+
+    def fit_zoom(self):
+        """Zoom that fits the whole image in the canvas, never enlarging it"""
+        width, height = self.canvas_size()
+        return min(width / self.pyramid.size[0], height / self.pyramid.size[1], 1.0)
+
+    def current_zoom(self):
+        return self.zoom or self.fit_zoom()
+
+    def set_view(self, zoom, center, sync=True):
+        """Move to zoom and centre, and move linked views with it"""
+        if zoom is not None and self.pyramid is not None:
+            # Zooming out as far as the fit returns to fit mode, which follows resizes
+            zoom = None if zoom <= self.fit_zoom() else min(zoom, MAX_ZOOM)
+        self.zoom = zoom
+        self.center = center
+        self.redraw()
+        if sync:
+            for view in self.linked:
+                view.set_view(zoom, center, sync=False)
+
+    def zoom_by(self, factor, x=None, y=None):
+        """Zoom by factor keeping the image point under canvas (x, y) in place"""
+        if self.pyramid is None:
+            return
+        width, height = self.canvas_size()
+        x = width / 2 if x is None else x
+        y = height / 2 if y is None else y
+        old = self.current_zoom()
+        new = min(max(old * factor, self.fit_zoom()), MAX_ZOOM)
+        img_w, img_h = self.pyramid.size
+        dx, dy = x - width / 2, y - height / 2
+        center = (self.center[0] + dx / (img_w * old) - dx / (img_w * new),
+                  self.center[1] + dy / (img_h * old) - dy / (img_h * new))
+        self.set_view(new, center)
+
+    def _start_pan(self, event):
+        self._drag = (event.x, event.y)
+
+    def _pan(self, event):
+        if self.pyramid is None or self._drag is None:
+            return
+        zoom = self.current_zoom()
+        dx, dy = event.x - self._drag[0], event.y - self._drag[1]
+        self._drag = (event.x, event.y)
+        self.set_view(self.zoom, (self.center[0] - dx / (self.pyramid.size[0] * zoom),
+                                  self.center[1] - dy / (self.pyramid.size[1] * zoom)))
+
+    def _wheel(self, event, zoom_in):
+        self.zoom_by(ZOOM_STEP if zoom_in else 1 / ZOOM_STEP, event.x, event.y)
+
+    def schedule_redraw(self):
+        """Redraw once when idle, however many resize events arrive"""
+        if not self._redraw_pending:
+            self._redraw_pending = True
+            self.canvas.after_idle(self.redraw)
+
+    def redraw(self):
+        """Draw the tiles that intersect the canvas at the current view"""
+        self._redraw_pending = False
+        if self.pyramid is None:
+            return
+        width, height = self.canvas_size()
+        zoom = round(self.current_zoom(), 6)
+        img_w = max(1, round(self.pyramid.size[0] * zoom))
+        img_h = max(1, round(self.pyramid.size[1] * zoom))
+        # Keep the image on screen: centred while it is smaller than the canvas
+        cx = min(max(self.center[0] * img_w, width / 2), img_w - width / 2) \
+            if img_w > width else img_w / 2
+        cy = min(max(self.center[1] * img_h, height / 2), img_h - height / 2) \
+            if img_h > height else img_h / 2
+        self.center = (cx / img_w, cy / img_h)
+        left, top = round(cx - width / 2), round(cy - height / 2)
+
+        size = self.tile_size
+        self.canvas.delete("all")
+        self._drawn = []
+        for row in range(max(0, top // size), min(img_h, top + height) // size + 1):
+            for col in range(max(0, left // size), min(img_w, left + width) // size + 1):
+                if col * size >= img_w or row * size >= img_h:
+                    continue
+                photo = self.tiles.get(self.pyramid, col, row, zoom, lambda: ImageTk.PhotoImage(
+                    self.pyramid.tile(col, row, zoom, size)))
+                self.canvas.create_image(col * size - left, row * size - top,
+                                         image=photo, anchor=tk.NW)
+                self._drawn.append(photo)
+
+        if (self.on_detail and self.zoom is not None and zoom > self.pyramid.scale(0)
+                and self._detail_requested != self.pyramid.id):
+            self._detail_requested = self.pyramid.id
+            self.on_detail()
+
+# ----------------- JOB SCHEDULER -------------------------
+
+class JobCancelled(Exception):
+    """Raised inside a job once a newer job has replaced it"""
+
+class Job:
+    """Cancellation token handed to every scheduled job"""
+
+    def __init__(self, kind, key, generation):
+        self.kind = kind
+        self.key = key
+        self.generation = generation
+        # (on_done, on_error) pairs, one per submit coalesced into this job
+        self.callbacks = []
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        """Stop the job between stages if it has been cancelled"""
+        if self.cancelled:
+            raise JobCancelled()
+
+class JobScheduler:
+    """Run GUI jobs on a worker pool and post their results back to Tk
+
+    There is at most one current job per kind. Submitting a new job of a
+    kind cancels the previous one and its result is dropped when it
+    finishes; submitting the same key again while it is still current is
+    coalesced into the running job, and its callbacks run as well when that
+    job finishes. Callbacks only ever run on the Tk thread, through
+    root.after.
+    """
+
+    def __init__(self, root, workers=4, on_busy=None):
+        self.root = root
+        self.on_busy = on_busy
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="job")
+        self._current = {}
+        self._generation = 0
+        self._pending = 0
+
+    def submit(self, kind, fn, on_done=None, on_error=None, key=None):
+        """Run fn(job) in the pool; call on_done(result) or on_error(exc) if still current
+
+        Must be called from the Tk thread.
+        """
+        current = self._current.get(kind)
+        if key is not None and current is not None and current.key == key:
+            current.callbacks.append((on_done, on_error))
+            return current
+        self.cancel(kind)
+        self._generation += 1
+        job = Job(kind, key, self._generation)
+        job.callbacks.append((on_done, on_error))
+        self._current[kind] = job
+        self._pending += 1
+        if self._pending == 1 and self.on_busy:
+            self.on_busy(True)
+        self.executor.submit(self._run, job, fn)
+        return job
+
+    def cancel(self, *kinds):
+        """Cancel the current job of each kind; their results will be dropped"""
+        for kind in kinds:
+            job = self._current.pop(kind, None)
+            if job is not None:
+                job.cancel()
+
+    def busy(self, kind):
+        return kind in self._current
+
+    def shutdown(self):
+        # Cancelled jobs return as soon as a worker takes them, and running
+        # batches stop after their current images, so the process can exit
+        self.cancel(*list(self._current))
+        self.executor.shutdown(wait=False)
+
+    def _run(self, job, fn):
+        failed, value = False, None
+        if not job.cancelled:
+            try:
+                value = fn(job)
+            except JobCancelled:
+                pass
+            except Exception as e:
+                failed, value = True, e
+        try:
+            self.root.after(0, self._finish, job, failed, value)
+        except (RuntimeError, tk.TclError):
+            pass  # the window has been closed
+
+    def _finish(self, job, failed, value):
+        self._pending -= 1
+        if self._pending == 0 and self.on_busy:
+            self.on_busy(False)
+        if job.cancelled or self._current.get(job.kind) is not job:
+            return
+        del self._current[job.kind]
+        for on_done, on_error in job.callbacks:
+            callback = on_error if failed else on_done
+            if callback:
+                callback(value)
+
 class BackgroundRemoverApp:
-    def __init__(self, root):
+    # Save dialog choices as (kind, crop) for the Encoder
+    OUTPUT_CHOICES = {
+        "Cutout": ("cutout", False),
+        "Cropped": ("cutout", True),
+        "Mask": ("mask", False),
+        "Mask (1-bit)": ("mask1", False),
+    }
+
+    # Model choices for Remove Background: the startup model or a speed/quality tier
+    QUALITY_CHOICES = {"Default": None, "Fast": "fast", "Balanced": "balanced", "Quality": "quality"}
+
+    def __init__(self, root, num_threads=0, history_bytes=256 * 1024 * 1024, max_batch=1,
+                 sessions=None):
         self.root = root
         self.root.title("Magical Background Remover")
         self.root.geometry("1000x750")
@@ -25,17 +2101,30 @@ class BackgroundRemoverApp:
         }
 
         self.input_image_path = None
-        self.output_image_path = None
-        self.output_image = None
-        self.original_output = None
-        self.history = []
-        
-        self.zoom_level = 1.0
-        self.is_processing = False
+        # True once the input image has been decoded and shown
+        self.input_ready = False
+        # (path, image) of the last full decode, shared by the viewer and inference
+        self.decoded = None
+        self.cutout_pyramid = None
+        self.chain = None
+        self.cutout = None
+        self.mask = None
+        # (frames, loop) of the cut out animation when the input has several frames
+        self.animation = None
+        self.history = EditHistory(history_bytes)
+        self.tiles = TileCache()
+        self.sessions = sessions or SessionManager(num_threads=num_threads, max_batch=max_batch)
+        self.loader = ImageLoader()
+        self.mask_cache = MaskCache()
+        self.tracer = Tracer()
+        self.batch_engines = {}
+        self.jobs = JobScheduler(root, on_busy=self.set_busy)
         
         self.setup_style()
         self.create_widgets()
         self.setup_keyboard_shortcuts()
+        # The window shows first; the model loads on the job pool meanwhile
+        self.prepare_model()
 
     # ----------------- STYLE SETUP -------------------------
     
@@ -69,6 +2158,12 @@ class BackgroundRemoverApp:
         self.status_label = tk.Label(self.root, text="Ready", font=("Arial", 10), 
                                      fg=self.colors['dark'])
         self.status_label.pack()
+        
+        self.cache_label = tk.Label(self.root, text="", font=("Arial", 9), fg="#888")
+        self.cache_label.pack()
+        
+        self.timing_label = tk.Label(self.root, text="", font=("Arial", 9), fg="#888")
+        self.timing_label.pack()
 
         frame = ttk.Frame(self.root)
         frame.pack(pady=10, padx=20, expand=True, fill=tk.BOTH)
@@ -98,6 +2193,14 @@ class BackgroundRemoverApp:
         self.output_canvas.pack(expand=True, fill=tk.BOTH, padx=5, pady=5)
         self.output_canvas.config(width=400, height=400)
 
+        # Both canvases zoom and pan together so edges can be compared
+        # Full resolution is only decoded or rendered once a zoom needs it
+        self.input_view = ImageView(self.input_canvas, self.tiles,
+                                    on_detail=self.show_input_detail)
+        self.output_view = ImageView(self.output_canvas, self.tiles,
+                                     on_detail=self.show_output_detail)
+        self.input_view.link(self.output_view)
+
         button_frame = ttk.Frame(self.root)
         button_frame.pack(pady=10)
 
@@ -113,6 +2216,22 @@ class BackgroundRemoverApp:
                                       command=self.batch_process, 
                                       style='Primary.TButton')
         self.batch_button.grid(row=0, column=2, padx=5)
+        
+        tk.Label(button_frame, text="Quality:").grid(row=0, column=5, padx=5)
+        self.quality_var = tk.StringVar(value="Default")
+        quality_combo = ttk.Combobox(button_frame, textvariable=self.quality_var,
+                                     values=list(self.QUALITY_CHOICES),
+                                     state="readonly", width=9)
+        quality_combo.grid(row=0, column=6, padx=5)
+        # Start loading the chosen model before it is needed
+        quality_combo.bind("<<ComboboxSelected>>", lambda e: self.prepare_model())
+        
+        tk.Label(button_frame, text="Batch background:").grid(row=0, column=3, padx=5)
+        self.batch_bg_var = tk.StringVar(value="Transparent")
+        batch_bg_combo = ttk.Combobox(button_frame, textvariable=self.batch_bg_var,
+                                      values=["Transparent", "Color", "Image"],
+                                      state="readonly", width=11)
+        batch_bg_combo.grid(row=0, column=4, padx=5)
 
         effects_frame = ttk.LabelFrame(self.root, text="Effects & Tools", padding=10)
         effects_frame.pack(pady=10, padx=20, fill=tk.X)
@@ -145,6 +2264,10 @@ class BackgroundRemoverApp:
                                      command=self.undo, state=tk.DISABLED)
         self.undo_button.grid(row=0, column=7, padx=7, pady=5)
         
+        self.redo_button = ttk.Button(effects_frame, text="↷ Redo", 
+                                     command=self.redo, state=tk.DISABLED)
+        self.redo_button.grid(row=0, column=8, padx=5, pady=5)
+        
         save_frame = ttk.Frame(self.root)
         save_frame.pack(pady=10)
         
@@ -159,6 +2282,16 @@ class BackgroundRemoverApp:
                                    values=["PNG", "JPEG", "WEBP", "BMP"], 
                                    state="readonly", width=8)
         format_combo.grid(row=0, column=2, padx=5)
+        
+        tk.Label(save_frame, text="Output:").grid(row=0, column=3, padx=5)
+        self.output_kind_var = tk.StringVar(value="Cutout")
+        output_combo = ttk.Combobox(save_frame, textvariable=self.output_kind_var,
+                                    values=list(self.OUTPUT_CHOICES),
+                                    state="readonly", width=12)
+        output_combo.grid(row=0, column=4, padx=5)
+        
+        ttk.Button(save_frame, text="Export Trace", 
+                  command=self.export_trace).grid(row=0, column=9, padx=5)
 
         footer = tk.Label(self.root, text="Developed by Hassan Ahmed for Hack Club | Press F1 for Help", 
                          fg="#888", font=("Arial", 9), bg=self.colors['light'])
@@ -171,9 +2304,14 @@ class BackgroundRemoverApp:
     def setup_keyboard_shortcuts(self):
         """Setup keyboard shortcuts"""
         self.root.bind('<Control-o>', lambda e: self.upload_image())
-        self.root.bind('<Control-s>', lambda e: self.save_output() if self.output_image_path else None)
+        self.root.bind('<Control-s>', lambda e: self.save_output() if self.chain else None)
         self.root.bind('<Control-z>', lambda e: self.undo())
+        self.root.bind('<Control-y>', lambda e: self.redo())
         self.root.bind('<F1>', lambda e: self.show_help())
+        self.root.bind('<plus>', lambda e: self.input_view.zoom_by(ZOOM_STEP))
+        self.root.bind('<equal>', lambda e: self.input_view.zoom_by(ZOOM_STEP))
+        self.root.bind('<minus>', lambda e: self.input_view.zoom_by(1 / ZOOM_STEP))
+        self.root.bind('<Key-0>', lambda e: self.input_view.set_view(None, (0.5, 0.5)))
         self.root.bind('<Escape>', lambda e: self.root.quit())
     
     def setup_drag_drop(self):
@@ -196,7 +2334,7 @@ class BackgroundRemoverApp:
         """Upload an image file"""
         path = filedialog.askopenfilename(
             title="Select an Image",
-            filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;*.bmp;*.webp;*.gif")]
+            filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;*.bmp;*.webp;*.gif;*.tif;*.tiff")]
         )
         if not path:
             return
@@ -204,85 +2342,223 @@ class BackgroundRemoverApp:
 
     def load_input_image(self, path):
         """Load and display input image"""
-        try:
-            self.input_image_path = path
-            img = Image.open(path)
-            
-            self.original_size = img.size
-            
-            img_display = img.copy()
-            img_display.thumbnail((300, 300), Image.Resampling.LANCZOS)
-            self.input_image = ImageTk.PhotoImage(img_display)
-            self.input_canvas.delete("all")
-            
-            canvas_width = self.input_canvas.winfo_width() or 400
-            canvas_height = self.input_canvas.winfo_height() or 400
-            x = canvas_width // 2
-            y = canvas_height // 2
-            self.input_canvas.create_image(x, y, image=self.input_image)
+        # Anything still being computed belongs to the previous image
+        self.jobs.cancel("remove", "pyramid", "render", "detail")
+        self.input_image_path = path
+        self.input_ready = False
+        self.decoded = None
+        self.cutout = None
+        self.mask = None
+        self.animation = None
+        self.chain = None
+        self.cutout_pyramid = None
+        self.history.reset(None)
+        self.output_view.clear()
+        self.update_history_buttons()
+        self.disable_effect_buttons()
+        self.save_button.config(state=tk.DISABLED)
+        self.update_remove_button()
+        self.update_status(f"Loading {os.path.basename(path)}...")
+
+        def load(job):
+            with self.tracer.operation("Load"):
+                with self.tracer.span("preview", path=path) as info:
+                    img_display, original_size = self.loader.preview(path)
+                    info["size"] = original_size
+            return img_display, original_size
+
+        def loaded(result):
+            img_display, self.original_size = result
+            # The preview stands in for the full image until a zoom needs more detail
+            self.input_view.show(ImagePyramid(img_display, self.original_size))
             
-            self.remove_bg_button.config(state=tk.NORMAL)
+            self.input_ready = True
+            self.update_remove_button()
             self.magic_button.config(state=tk.NORMAL)
             self.update_status(f"Loaded: {os.path.basename(path)}")
-        except Exception as e:
+            self.show_timing()
+
+        def failed(e):
             messagebox.showerror("Error", f"Failed to load image: {e}")
             self.update_status("Error loading image")
 
-    def remove_background_threaded(self):
-        """Remove background in a separate thread to prevent UI freezing"""
-        if self.is_processing:
-            messagebox.showwarning("Processing", "Please wait for current operation to complete")
+        self.jobs.submit("load", load, loaded, failed, key=path)
+
+    def decode_source(self, path, data):
+        """Decode the input once; the input view and Remove Background share it
+
+        The decode is kept only until Remove Background has made its cutout.
+        """
+        decoded = self.decoded
+        if decoded is not None and decoded[0] == path:
+            return decoded[1]
+        src = decode_image(data)
+        self.decoded = (path, src)
+        return src
+
+    def show_input_detail(self):
+        """Swap the input preview for a full resolution pyramid (zoomed in past it)"""
+        path = self.input_image_path
+
+        def build(job):
+            with self.tracer.span("pyramid", path=path) as info:
+                with open(path, 'rb') as f:
+                    src = self.decode_source(path, f.read())
+                job.check()
+                pyramid = ImagePyramid(src)
+                info["levels"] = len(pyramid.levels)
+            return pyramid
+
+        self.jobs.submit("pyramid", build,
+                         lambda pyramid: self.input_view.show(pyramid, keep_view=True), key=path)
+
+    def show_output_detail(self):
+        """Render the effects at full resolution for an output zoomed in past the preview"""
+        chain = self.chain
+        if chain is None or not chain.steps:
             return
+        steps = tuple(chain.steps)
+
+        def render(job):
+            with self.tracer.span("render_full", size=chain.base.size):
+                img = chain.render_full(steps)
+            job.check()
+            return ImagePyramid(img)
+
+        def rendered(pyramid):
+            if self.chain is chain and tuple(chain.steps) == steps:
+                self.output_view.show(pyramid, keep_view=True)
+
+        self.jobs.submit("detail", render, rendered, key=(id(chain), steps))
+
+    def remove_background_threaded(self):
+        """Remove background on the job pool; repeated clicks join the running job"""
+        path = self.input_image_path
         
-        thread = threading.Thread(target=self.remove_background)
-        thread.daemon = True
-        thread.start()
+        def done(result):
+            # Clicks coalesced into one job, or a Magic Touch, may have shown it already
+            if self.chain is result[3]:
+                return
+            self.show_cutout(result)
+            self.update_status("Background removed successfully!")
+            messagebox.showinfo("Success", "Background removed successfully!")
     
-    def remove_background(self):
-        """Remove background from the image"""
-        try:
-            self.is_processing = True
-            self.update_status("Removing background...")
-            self.show_progress()
-            
-            with open(self.input_image_path, 'rb') as f:
-                output_data = remove(f.read())
-            
-            self.output_image_path = "temp_output.png"
-            with open(self.output_image_path, 'wb') as out:
-                out.write(output_data)
+        def failed(e):
+            self.update_status("Error removing background")
+            messagebox.showerror("Error", f"Failed: {e}")
             
-            img = Image.open(self.output_image_path)
-            self.save_to_history(img)
-            self.display_output(img)
+        self.update_status("Removing background...")
+        sessions = self.current_sessions()
+        self.jobs.submit("remove", lambda job: self.remove_background(path, job, sessions),
+                         done, failed, key=(path, sessions.model_name))
+                
+    def current_sessions(self):
+        """The session manager for the selected quality"""
+        tier = self.QUALITY_CHOICES[self.quality_var.get()]
+        return self.sessions.for_tier(tier) if tier else self.sessions
+
+    def prepare_model(self):
+        """Import the segmentation stack and warm the selected model on the job pool"""
+        sessions = self.current_sessions()
+        self.update_remove_button()
+        if sessions.is_ready():
+            return
+
+        def failed(e):
+            self.update_remove_button()
+            self.update_status("Model unavailable")
+            messagebox.showerror("Error", f"Failed to load model {sessions.model_name}: {e}")
+
+        self.jobs.submit("model", lambda job: sessions.warm(),
+                         lambda result: self.update_remove_button(), failed,
+                         key=sessions.model_name)
+
+    def update_remove_button(self):
+        """Show on Remove Background whether the selected model can be used yet"""
+        sessions = self.current_sessions()
+        if sessions.is_ready():
+            text, ready = "Remove Background", self.input_ready
+        elif sessions.error is not None:
+            text, ready = "Model unavailable", False
+        else:
+            text, ready = "Loading model...", False
+        self.remove_bg_button.config(text=text, state=tk.NORMAL if ready else tk.DISABLED)
+
+    def batch_engine_for(self, sessions):
+        """One batch engine per model, so worker sessions stay warm between batches"""
+        if sessions.model_name not in self.batch_engines:
+            self.batch_engines[sessions.model_name] = BatchEngine(
+                sessions, cache=self.mask_cache, tracer=self.tracer)
+        return self.batch_engines[sessions.model_name]
+
+    def remove_background(self, path, job, sessions):
+        """Segment an image and build its effect chain (runs on the job pool)"""
+        with self.tracer.operation("Remove background"):
+            mask, cutout, animation = self.compute_cutout(path, job, sessions)
+            job.check()
+            with self.tracer.span("proxy", size=cutout.size):
+                chain = EffectChain(cutout)
+            with self.tracer.span("pyramid", size=cutout.size):
+                pyramid = ImagePyramid(cutout)
+        return mask, cutout, animation, chain, pyramid
             
-            self.root.after(0, lambda: self.enable_effect_buttons())
-            self.root.after(0, lambda: self.save_button.config(state=tk.NORMAL))
+    def show_cutout(self, result):
+        """Make a finished cutout the current output (runs on the Tk thread)"""
+        self.mask, self.cutout, self.animation, self.chain, self.cutout_pyramid = result
+        self.history.reset(self.chain)
+        self.update_history_buttons()
+        self.update_cache_stats()
+        self.display_output()
+        self.show_timing()
+        self.enable_effect_buttons()
+        self.save_button.config(state=tk.NORMAL)
             
-            self.hide_progress()
-            self.update_status("Background removed successfully!")
-            self.root.after(0, lambda: messagebox.showinfo("Success", "Background removed successfully!"))
-        except Exception as e:
-            self.hide_progress()
-            self.update_status("Error removing background")
-            self.root.after(0, lambda: messagebox.showerror("Error", f"Failed: {e}"))
-        finally:
-            self.is_processing = False
+    def compute_cutout(self, path, job, sessions):
+        """Read, decode and segment an image, returning (mask, cutout, animation)"""
+        with self.tracer.span("read", path=path) as info:
+            with open(path, 'rb') as f:
+                data = f.read()
+            info["bytes"] = len(data)
+        job.check()
+        src = open_image(data)
+        if is_animated(src):
+            # Every frame is cut out now; effects are previewed on the first
+            # frame and applied to all of them when saving
+            frames = []
+            with self.tracer.span("frames", size=src.size) as info:
+                for frame in cutout_frames(src, sessions.predictor(), stats=info):
+                    job.check()
+                    frames.append(frame)
+            cutout = frames[0][0]
+            return cutout.getchannel("A"), cutout, (frames, src.info.get("loop", 0))
+        with self.tracer.span("decode") as info:
+            src = self.decode_source(path, data)
+            info["size"] = src.size
+        job.check()
+        hits = self.mask_cache.hits
+        with self.tracer.span("inference", size=src.size) as info:
+            mask = compute_mask(data, src, sessions.predictor(),
+                                sessions.settings(), self.mask_cache)
+            info["cached"] = self.mask_cache.hits > hits
+        job.check()
+        with self.tracer.span("cutout", size=src.size):
+            cutout = apply_mask(src, mask)
+        # The cutout replaces the decoded source; a zoomed input view keeps its own
+        self.decoded = None
+        return mask, cutout, None
 
-    def display_output(self, img):
-        """Display output image on canvas"""
-        self.original_output = img.copy()
-        
-        img_display = img.copy()
-        img_display.thumbnail((400, 400), Image.Resampling.LANCZOS)
-        self.output_image = ImageTk.PhotoImage(img_display)
-        
-        self.output_canvas.delete("all")
-        canvas_width = self.output_canvas.winfo_width() or 400
-        canvas_height = self.output_canvas.winfo_height() or 400
-        x = canvas_width // 2
-        y = canvas_height // 2
-        self.output_canvas.create_image(x, y, image=self.output_image)
+    def display_output(self, preview=None):
+        """Display an effect preview, or the plain cutout at full resolution
+
+        The preview is rendered on the chain's proxy and is shown scaled to
+        the cutout's size, so the output view keeps the input's zoom and pan;
+        zooming in past it renders the effects at full resolution.
+        """
+        pyramid = self.cutout_pyramid
+        if preview is not None:
+            pyramid = ImagePyramid(preview, self.chain.base.size)
+        with self.tracer.span("display", size=pyramid.size):
+            self.output_view.show(pyramid, keep_view=True)
 
     # -------------------------- EFFECT FUNCTIONS ---------------------
     
@@ -291,134 +2567,86 @@ class BackgroundRemoverApp:
         if not self.input_image_path:
             messagebox.showwarning("Warning", "Upload an image first!")
             return
-        try:
-            self.update_status("Applying magic touch...")
-            
-            with open(self.input_image_path, 'rb') as f:
-                output_data = remove(f.read())
-            
-            with open("magic_temp.png", 'wb') as out:
-                out.write(output_data)
+        path = self.input_image_path
             
-            img = Image.open("magic_temp.png").convert("RGBA")
-            
-            img = ImageEnhance.Brightness(img).enhance(1.2)
-            img = ImageEnhance.Contrast(img).enhance(1.3)
-            img = ImageEnhance.Sharpness(img).enhance(1.5)
-
-            gradient = Image.new("RGBA", img.size, "#ffffff")
-            for y in range(img.height):
-                r = int(255 - (y / img.height) * 40)
-                g = int(255 - (y / img.height) * 60)
-                b = int(255 - (y / img.height) * 80)
-                for x in range(img.width):
-                    gradient.putpixel((x, y), (r, g, b, 255))
-
-            gradient.paste(img, (0, 0), img)
-            
-            self.save_to_history(gradient)
-            self.display_output(gradient)
-            self.save_button.config(state=tk.NORMAL)
-            self.enable_effect_buttons()
-            
-            if os.path.exists("magic_temp.png"):
-                os.remove("magic_temp.png")
+        def apply_magic():
+            self.apply_step("magic", reset=True, status="Magic applied!",
+                            on_done=lambda: messagebox.showinfo(
+                                "Magic Complete!", "Your image has been magically enhanced!"))
                 
-            self.update_status("Magic applied!")
-            messagebox.showinfo("Magic Complete!", "Your image has been magically enhanced!")
+        def cut_out(result):
+            # Remove Background may have shown this result already
+            if self.chain is not result[3]:
+                self.show_cutout(result)
+            apply_magic()
 
-        except Exception as e:
+        def failed(e):
             messagebox.showerror("Error", f"Magic failed: {e}")
             self.update_status("Magic failed")
+
+        self.update_status("Applying magic touch...")
+        # Reuse the cutout from Remove Background instead of running inference again
+        if self.cutout is None:
+            sessions = self.current_sessions()
+            self.jobs.submit("remove", lambda job: self.remove_background(path, job, sessions),
+                             cut_out, failed, key=(path, sessions.model_name))
+        else:
+            apply_magic()
     
     def apply_blur(self):
         """Apply blur effect"""
-        if not self.original_output:
+        if not self.chain:
             messagebox.showwarning("Warning", "Process an image first!")
             return
-        try:
-            img = self.original_output.copy()
-            img = img.filter(ImageFilter.GaussianBlur(radius=5))
-            self.save_to_history(img)
-            self.display_output(img)
-            self.update_status("Blur effect applied")
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to apply blur: {e}")
+        self.apply_step("blur", status="Blur effect applied")
     
     def apply_sharpen(self):
         """Apply sharpen effect"""
-        if not self.original_output:
+        if not self.chain:
             messagebox.showwarning("Warning", "Process an image first!")
             return
-        try:
-            img = self.original_output.copy()
-            img = img.filter(ImageFilter.SHARPEN)
-            self.save_to_history(img)
-            self.display_output(img)
-            self.update_status("Sharpen effect applied")
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to apply sharpen: {e}")
+        self.apply_step("sharpen", status="Sharpen effect applied")
     
     def apply_grayscale(self):
         """Apply grayscale effect"""
-        if not self.original_output:
+        if not self.chain:
             messagebox.showwarning("Warning", "Process an image first!")
             return
-        try:
-            img = self.original_output.copy()
-            img = ImageOps.grayscale(img).convert("RGBA")
-            self.save_to_history(img)
-            self.display_output(img)
-            self.update_status("Grayscale effect applied")
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to apply grayscale: {e}")
+        self.apply_step("grayscale", status="Grayscale effect applied")
 
     def replace_bg_color(self):
         """Replace background with solid color"""
-        if not self.output_image_path:
+        if self.cutout is None:
             messagebox.showwarning("Warning", "Remove the background first!")
             return
         color = colorchooser.askcolor(title="Pick a background color")[1]
         if not color:
             return
-        try:
-            img = Image.open(self.output_image_path).convert("RGBA")
-            bg = Image.new("RGBA", img.size, color)
-            bg.paste(img, (0, 0), img)
-            self.save_to_history(bg)
-            self.display_output(bg)
-            self.update_status(f"Background replaced with {color}")
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to replace background: {e}")
+        self.apply_step("bgcolor", color, reset=True, status=f"Background replaced with {color}")
 
     def replace_bg_image(self):
         """Replace background with another image"""
-        if not self.output_image_path:
+        if self.cutout is None:
             messagebox.showwarning("Warning", "Remove the background first!")
             return
         bg_path = filedialog.askopenfilename(
             title="Select Background Image",
-            filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;*.bmp;*.webp")]
+            filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;*.bmp;*.webp;*.gif;*.tif;*.tiff")]
         )
         if not bg_path:
             return
-        try:
-            img = Image.open(self.output_image_path).convert("RGBA")
-            bg = Image.open(bg_path).convert("RGBA").resize(img.size, Image.Resampling.LANCZOS)
-            bg.paste(img, (0, 0), img)
-            self.save_to_history(bg)
-            self.display_output(bg)
-            self.update_status("Background replaced with image")
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to replace background: {e}")
+        self.apply_step("bgimage", bg_path, reset=True, status="Background replaced with image")
     
     # -------------------------- BATCH PROCESSING ---------------------
     
     def batch_process(self):
         """Process multiple images at once"""
+        if self.jobs.busy("batch"):
+            messagebox.showwarning("Processing", "Please wait for the current batch to complete")
+            return
         paths = filedialog.askopenfilenames(
             title="Select Images to Process",
-            filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;*.bmp;*.webp")]
+            filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;*.bmp;*.webp;*.gif;*.tif;*.tiff")]
         )
         if not paths:
             return
@@ -427,60 +2655,135 @@ class BackgroundRemoverApp:
         if not output_dir:
             return
         
+        # One background for the whole batch; it is decoded and fitted once
+        # per cutout size rather than once per image
+        effects = []
+        background = self.batch_bg_var.get()
+        if background == "Color":
+            color = colorchooser.askcolor(title="Pick a background for every cutout")[1]
+            if not color:
+                return
+            effects = [("bgcolor", (color,))]
+        elif background == "Image":
+            bg_path = filedialog.askopenfilename(
+                title="Select Background for Every Cutout",
+                filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;*.bmp;*.webp;*.gif;*.tif;*.tiff")]
+            )
+            if not bg_path:
+                return
+            effects = [("bgimage", (bg_path,))]
+        
         self.update_status(f"Processing {len(paths)} images...")
-        self.show_progress()
         
-        def batch_worker():
-            try:
-                for i, path in enumerate(paths):
-                    with open(path, 'rb') as f:
-                        output_data = remove(f.read())
-                    
-                    filename = os.path.splitext(os.path.basename(path))[0]
-                    output_path = os.path.join(output_dir, f"{filename}_nobg.png")
-                    
-                    with open(output_path, 'wb') as out:
-                        out.write(output_data)
-                    
-                    self.root.after(0, lambda i=i: self.update_status(
-                        f"Processed {i+1}/{len(paths)} images"))
-                
-                self.root.after(0, lambda: self.hide_progress())
-                self.root.after(0, lambda: self.update_status(
-                    f"Batch processing complete! Saved to {output_dir}"))
-                self.root.after(0, lambda: messagebox.showinfo(
-                    "Success", f"Processed {len(paths)} images successfully!"))
-            except Exception as e:
-                self.root.after(0, lambda: self.hide_progress())
-                self.root.after(0, lambda: messagebox.showerror(
-                    "Error", f"Batch processing failed: {e}"))
+        def on_progress(done, total, path, error, skipped):
+            name = os.path.basename(path)
+            if skipped:
+                message = f"Processed {done}/{total} images ({name} is up to date)"
+            elif error is None:
+                message = f"Processed {done}/{total} images ({name})"
+            else:
+                message = f"Processed {done}/{total} images (failed: {name})"
+            self.root.after(0, lambda: self.update_status(message))
+            self.root.after(0, self.update_cache_stats)
+
+        def finished(result):
+            processed, skipped, failed = result
+            self.update_status(f"Batch processing complete! Saved to {output_dir}")
+            summary = f"Processed {len(processed)} images"
+            if skipped:
+                summary += f", skipped {len(skipped)} already up to date"
+            if failed:
+                details = "\n".join(f"{os.path.basename(p)}: {err}" for p, err in failed[:10])
+                if len(failed) > 10:
+                    details += f"\n...and {len(failed) - 10} more"
+                messagebox.showwarning(
+                    "Batch Finished",
+                    f"{summary}, {len(failed)} failed:\n{details}\n\n"
+                    "Run the same batch again to retry only the failed images.")
+            else:
+                messagebox.showinfo("Success", f"{summary}." if skipped else f"{summary} successfully!")
         
-        thread = threading.Thread(target=batch_worker)
-        thread.daemon = True
-        thread.start()
+        def crashed(e):
+            self.update_status("Batch processing failed")
+            messagebox.showerror("Error", f"Batch processing failed: {e}")
+
+        engine = self.batch_engine_for(self.current_sessions())
+        # Cancelled by closing the window, so the app doesn't linger until the batch ends
+        self.jobs.submit("batch", lambda job: engine.run(
+            paths, output_dir, on_progress, effects, lambda: job.cancelled), finished, crashed)
     
     # -------------------------- FUNCTIONS ---------------------
     
-    def save_to_history(self, img):
-        """Save current state to history for undo"""
-        self.history.append(self.original_output.copy() if self.original_output else None)
-        if len(self.history) > 10:  # Keep only last 10 states
-            self.history.pop(0)
-        self.undo_button.config(state=tk.NORMAL)
+    def apply_step(self, name, *args, reset=False, status=None, on_done=None):
+        """Record an effect step on the chain and refresh the preview
+
+        With reset=True the step replaces earlier effects and starts again
+        from the plain cutout.
+        """
+        if reset and (self.chain is None or self.chain.base is not self.cutout):
+            self.chain = EffectChain(self.cutout)
+            self.history.reset(self.chain)
+        steps = [] if reset else list(self.chain.steps)
+        steps.append((name, args))
+        self.chain.steps = steps
+        self.history.record()
+        self.update_history_buttons()
+        self.render_preview(f"Effect {name}", f"effect.{name}", status, on_done)
+
+    def render_preview(self, operation, span, status=None, on_done=None):
+        """Render the chain's current steps on the job pool and display them
+
+        A newer render replaces one that is still queued or running, so a
+        burst of clicks only draws the final state.
+        """
+        chain = self.chain
+        steps = tuple(chain.steps)
+
+        def render(job):
+            with self.tracer.operation(operation):
+                with self.tracer.span(span, size=chain.proxy_base.size):
+                    return chain.render_proxy(steps)
+
+        def rendered(preview):
+            self.display_output(preview if steps else None)
+            self.show_timing()
+            if status:
+                self.update_status(status)
+            if on_done:
+                on_done()
+
+        def failed(e):
+            messagebox.showerror("Error", f"{operation} failed: {e}")
+            self.update_status(f"{operation} failed")
+
+        self.jobs.submit("render", render, rendered, failed, key=(id(chain), steps))
+    
+    def update_history_buttons(self):
+        """Enable undo/redo according to the edit history"""
+        self.undo_button.config(state=tk.NORMAL if self.history.can_undo() else tk.DISABLED)
+        self.redo_button.config(state=tk.NORMAL if self.history.can_redo() else tk.DISABLED)
     
     def undo(self):
         """Undo last operation"""
-        if not self.history:
+        steps = self.history.undo()
+        if steps is None:
             messagebox.showinfo("Info", "Nothing to undo")
             return
         
-        previous_state = self.history.pop()
-        if previous_state:
-            self.display_output(previous_state)
-            self.update_status("Undo successful")
+        self.chain.steps = list(steps)
+        self.update_history_buttons()
+        self.render_preview("Undo", "render", "Undo successful")
+    
+    def redo(self):
+        """Redo the last undone operation"""
+        steps = self.history.redo()
+        if steps is None:
+            messagebox.showinfo("Info", "Nothing to redo")
+            return
         
-        if not self.history:
-            self.undo_button.config(state=tk.DISABLED)
+        self.chain.steps = list(steps)
+        self.update_history_buttons()
+        self.render_preview("Redo", "render", "Redo successful")
     
     def enable_effect_buttons(self):
         """Enable all effect buttons"""
@@ -491,10 +2794,48 @@ class BackgroundRemoverApp:
         self.replace_color_button.config(state=tk.NORMAL)
         self.replace_img_button.config(state=tk.NORMAL)
     
+    def disable_effect_buttons(self):
+        """Disable all effect buttons until there is something to apply them to"""
+        self.magic_button.config(state=tk.DISABLED)
+        self.blur_button.config(state=tk.DISABLED)
+        self.sharpen_button.config(state=tk.DISABLED)
+        self.grayscale_button.config(state=tk.DISABLED)
+        self.replace_color_button.config(state=tk.DISABLED)
+        self.replace_img_button.config(state=tk.DISABLED)
+    
     def update_status(self, message):
         """Update status label"""
         self.status_label.config(text=message)
     
+    def show_timing(self):
+        """Show the timing breakdown of the last operation"""
+        self.timing_label.config(text=self.tracer.summary())
+    
+    def export_trace(self):
+        """Export the rolling timing trace as JSON lines"""
+        path = filedialog.asksaveasfilename(
+            defaultextension=".jsonl",
+            filetypes=[("JSON Lines", "*.jsonl"), ("All Files", "*.*")]
+        )
+        if not path:
+            return
+        try:
+            count = self.tracer.export(path)
+            self.update_status(f"Exported {count} trace records to {os.path.basename(path)}")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to export trace: {e}")
+    
+    def update_cache_stats(self):
+        """Show mask cache hit/miss counters under the status label"""
+        self.cache_label.config(text=self.mask_cache.stats_text())
+    
+    def set_busy(self, busy):
+        """Show the progress bar while any job is running"""
+        if busy:
+            self.show_progress()
+        else:
+            self.hide_progress()
+    
     def show_progress(self):
         """Show progress bar"""
         self.progress.pack(before=self.status_label, pady=5)
@@ -514,11 +2855,15 @@ Keyboard Shortcuts:
     • Ctrl+O: Upload Image
     • Ctrl+S: Save Output
     • Ctrl+Z: Undo
+    • Ctrl+Y: Redo
+    • +/-: Zoom in/out, 0: Fit to window
     • F1: Show Help
     • ESC: Exit
 
 Features:
     • Drag & Drop: Drag images directly onto the input area
+    • Zoom & Pan: Mouse wheel zooms, dragging pans, double-click fits;
+      both images move together
     • Remove Background: AI-powered background removal
     • Magic Touch: Auto-enhance with gradient background
     • Effects: Blur, Sharpen, Grayscale
@@ -526,19 +2871,26 @@ Features:
     • Batch Process: Process multiple images at once
 
 Supported Formats:
-    • Input: PNG, JPEG, BMP, WEBP, GIF
+    • Input: PNG, JPEG, BMP, WEBP, GIF, TIFF
     • Output: PNG, JPEG, WEBP, BMP
+    • Animated GIF/WEBP/TIFF keep every frame: saved as animated
+      PNG or WEBP (multi-page TIFF stays TIFF)
         """
         messagebox.showinfo("Help", help_text)
 
     def save_output(self):
         """Save the output image"""
-        if not self.original_output:
+        if not self.chain:
             messagebox.showwarning("Warning", "No output to save!")
             return
         
-        file_format = self.format_var.get()
+        kind, crop = self.OUTPUT_CHOICES[self.output_kind_var.get()]
+        encoder = Encoder(self.format_var.get(), kind, crop)
+        file_format = encoder.file_format
         ext = file_format.lower()
+        if self.animation and file_format not in ANIMATION_FORMATS:
+            messagebox.showwarning("Animation", "Animated results can be saved as PNG or WEBP")
+            return
         
         save_path = filedialog.asksaveasfilename(
             defaultextension=f".{ext}",
@@ -550,25 +2902,341 @@ Supported Formats:
         if not save_path:
             return
         
-        try:
-            img = self.original_output.copy()
-            
-            if file_format == "JPEG" and img.mode == "RGBA":
-                rgb_img = Image.new("RGB", img.size, (255, 255, 255))
-                rgb_img.paste(img, mask=img.split()[3])
-                img = rgb_img
-            
-            img.save(save_path, file_format)
+        # Render the full resolution result off the UI thread
+        chain = self.chain
+        steps = tuple(chain.steps)
+        animation = self.animation
+        
+        def save_worker(job):
+            with self.tracer.operation("Save"):
+                if animation:
+                    frames, loop = animation
+                    with self.tracer.span("encode", size=chain.base.size,
+                                          format=file_format, frames=len(frames)):
+                        save_animation(encoder.prepare_frames(frames, steps), save_path,
+                                       file_format, loop, **encoder.options())
+                else:
+                    result = None
+                    if kind == "cutout":
+                        with self.tracer.span("render_full", size=chain.base.size):
+                            result = chain.render_full(steps)
+                    img = encoder.prepare(chain.base, result=result)
+                    with self.tracer.span("encode", size=img.size, format=file_format):
+                        encoder.save(img, save_path)
+
+        def saved(result):
+            self.show_timing()
             self.update_status(f"Saved to {os.path.basename(save_path)}")
             messagebox.showinfo("Saved", f"Saved successfully to:\n{save_path}")
-        except Exception as e:
+
+        def failed(e):
+            self.update_status("Error saving image")
             messagebox.showerror("Error", f"Failed to save image: {e}")
+        
+        self.update_status("Saving...")
+        # Saves to different files run side by side instead of replacing each other
+        self.jobs.submit(("save", save_path), save_worker, saved, failed)
 
-if __name__ == "__main__":
+# -------------------------- COMMAND LINE ---------------------
+
+def expand_inputs(inputs):
+    """Expand files, glob patterns and directories into a sorted list of image paths"""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = [entry.path for entry in os.scandir(item) if entry.is_file()]
+        elif glob.has_magic(item):
+            candidates = glob.glob(item)
+        else:
+            candidates = [item]
+        paths.extend(p for p in candidates if p.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(set(paths))
+
+def print_progress(done, total, path, error, skipped=False):
+    """Progress callback for the command line"""
+    if skipped:
+        print(f"[{done}/{total}] {path} (up to date)")
+    elif error is None:
+        print(f"[{done}/{total}] {path}")
+    else:
+        print(f"[{done}/{total}] {path} FAILED: {error}", file=sys.stderr)
+
+def print_throughput(engine, processed, skipped, failed, elapsed):
+    """Print a one-line summary of a headless run"""
+    rate = len(processed) / elapsed if elapsed > 0 else 0.0
+    print(f"Processed {len(processed)} images, {len(skipped)} skipped, {len(failed)} failed "
+          f"in {elapsed:.1f}s ({rate:.2f} images/s)")
+    if engine.cache:
+        print(engine.cache.stats_text())
+
+def run_process(engine, args):
+    """Process the given inputs once and exit"""
+    paths = expand_inputs(args.inputs)
+    if not paths:
+        print("No input images found", file=sys.stderr)
+        return 1
+    os.makedirs(args.output, exist_ok=True)
+    start = time.perf_counter()
+    processed, skipped, failed = engine.run(paths, args.output, print_progress)
+    print_throughput(engine, processed, skipped, failed, time.perf_counter() - start)
+    return 1 if failed else 0
+
+def run_watch(engine, args):
+    """Watch a folder and process new images as they land until interrupted"""
+    os.makedirs(args.output, exist_ok=True)
+    output_dir = os.path.abspath(args.output)
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+
+    seen = set()
+    sizes = {}
+    processed, skipped, failed = [], [], []
+    start = time.perf_counter()
+    engine.sessions.get()
+    print(f"Watching {args.folder} (Ctrl+C to stop)")
+
+    while not stop.is_set():
+        ready = []
+        for path in expand_inputs([args.folder]):
+            if path in seen or os.path.dirname(os.path.abspath(path)) == output_dir:
+                continue
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            # Only pick a file up once its size has stopped changing
+            if sizes.get(path) == size:
+                ready.append(path)
+                seen.add(path)
+                sizes.pop(path)
+            else:
+                sizes[path] = size
+        if ready:
+            done, current, bad = engine.run(ready, args.output, print_progress,
+                                            cancelled=stop.is_set)
+            processed.extend(done)
+            skipped.extend(current)
+            failed.extend(bad)
+        stop.wait(args.interval)
+
+    print_throughput(engine, processed, skipped, failed, time.perf_counter() - start)
+    return 0
+
+def effect_arg(spec):
+    """argparse type for --effect that reports why a spec was rejected"""
     try:
-        root = TkinterDnD.Tk()
-    except:
-        root = tk.Tk()
-    
-    app = BackgroundRemoverApp(root)
-    root.mainloop()
\ No newline at end of file
+        return parse_effect(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from None
+
+def build_parser():
+    """Command line interface; with no command the desktop app starts"""
+    parser = argparse.ArgumentParser(description="Magical Background Remover")
+    parser.add_argument("--trace", default=None,
+                        help="write a JSON lines timing trace here when a command finishes")
+    parser.add_argument("--history-mb", type=int, default=256,
+                        help="memory budget for undo history in the desktop app")
+    parser.add_argument("--startup-time", metavar="IMAGE", default=None,
+                        help="start the desktop app, cut out IMAGE, print the time to "
+                             "first window and first cutout as JSON and quit")
+    parser.add_argument("--threads", type=int,
+                        default=int(os.environ.get("BGREMOVER_THREADS", "0")),
+                        help="ONNX Runtime intra-op threads per session (0 = auto)")
+    parser.add_argument("--inter-threads", type=int, default=0,
+                        help="ONNX Runtime inter-op threads per session (0 = auto)")
+    parser.add_argument("--provider", default=None,
+                        help="ONNX Runtime execution provider, e.g. CPUExecutionProvider")
+    parser.add_argument("--optimization", default="all", choices=GRAPH_OPTIMIZATION_LEVELS,
+                        help="ONNX Runtime graph optimization level")
+    models = parser.add_mutually_exclusive_group()
+    models.add_argument("--model", default="u2net",
+                        help="segmentation model, e.g. u2net, u2netp, silueta, "
+                             "isnet-general-use or u2net_custom")
+    models.add_argument("--tier", choices=MODEL_TIERS,
+                        help="pick the model by speed/quality: "
+                             + ", ".join(f"{tier}={model}" for tier, model in MODEL_TIERS.items()))
+    parser.add_argument("--model-path", default=None,
+                        help="run this local (e.g. quantized) ONNX file with the model's "
+                             "pre/post-processing; use --model u2net_custom for other U2-Net exports")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="combine up to this many concurrent images into one model run")
+    parser.add_argument("--batch-wait-ms", type=float, default=10,
+                        help="how long a model run waits for more images to batch")
+    commands = parser.add_subparsers(dest="command")
+
+    def add_output_options(sub):
+        sub.add_argument("-o", "--output", required=True, help="output directory")
+        sub.add_argument("-f", "--format", default="PNG", type=str.upper,
+                         choices=["PNG", "JPEG", "WEBP", "BMP"], help="output format")
+        sub.add_argument("-e", "--effect", action="append", default=[], type=effect_arg,
+                         help="effect to apply, in order: magic[:preset], blur[:radius], sharpen, "
+                              "grayscale, bgcolor:#rrggbb, bgimage:path")
+        sub.add_argument("-w", "--workers", type=int, default=None,
+                         help="number of inference workers")
+        sub.add_argument("--writers", type=int, default=None,
+                         help="number of threads encoding and writing results")
+        sub.add_argument("--kind", default="cutout", choices=OUTPUT_KINDS,
+                         help="write the cutout, its 8-bit mask or a 1-bit mask (masks are PNG)")
+        sub.add_argument("--crop", action="store_true", help="crop outputs to the subject")
+        sub.add_argument("--force", action="store_true",
+                         help="reprocess inputs even if the manifest says their outputs are current")
+        add_encoder_options(sub)
+        add_cache_options(sub)
+
+    def add_encoder_options(sub):
+        sub.add_argument("--png-level", type=int, default=6, choices=range(10), metavar="0-9",
+                         help="PNG zlib compression level (lower is faster, larger)")
+        sub.add_argument("--webp-quality", type=int, default=80, help="WEBP quality (0-100)")
+        sub.add_argument("--webp-lossless", action="store_true", help="encode WEBP losslessly")
+        sub.add_argument("--webp-method", type=int, default=4, choices=range(7), metavar="0-6",
+                         help="WEBP effort (lower is faster)")
+        sub.add_argument("--jpeg-quality", type=int, default=75, help="JPEG quality (1-95)")
+        sub.add_argument("--jpeg-subsampling", default="4:2:0", choices=JPEG_SUBSAMPLING,
+                         help="JPEG chroma subsampling")
+        sub.add_argument("--premultiplied", action="store_true",
+                         help="blur and sharpen with premultiplied alpha, so cutout "
+                              "edges don't darken")
+
+    def add_cache_options(sub):
+        sub.add_argument("--cache-dir", default=None, help="mask cache directory")
+        sub.add_argument("--cache-size", type=int, default=512,
+                         help="mask cache budget in MB (0 disables the cache)")
+
+    process = commands.add_parser("process", help="remove backgrounds and exit")
+    process.add_argument("inputs", nargs="+", help="image files, glob patterns or directories")
+    add_output_options(process)
+
+    watch = commands.add_parser("watch", help="process new images dropped into a folder")
+    watch.add_argument("folder", help="folder to watch")
+    watch.add_argument("--interval", type=float, default=1.0, help="poll interval in seconds")
+    add_output_options(watch)
+
+    serve = commands.add_parser("serve", help="run a local HTTP background removal service")
+    serve.add_argument("--host", default="127.0.0.1", help="address to bind (default: localhost only)")
+    serve.add_argument("--port", type=int, default=8765, help="port to listen on")
+    serve.add_argument("--concurrency", type=int, default=2, help="images processed at once")
+    serve.add_argument("--queue-size", type=int, default=8,
+                       help="requests allowed to wait before answering 429")
+    add_encoder_options(serve)
+    add_cache_options(serve)
+    return parser
+
+def encoder_from_args(args, file_format="PNG", kind="cutout", crop=False):
+    """Build an Encoder from the encoder tuning options"""
+    return Encoder(file_format, kind, crop, png_compress_level=args.png_level,
+                   webp_quality=args.webp_quality, webp_lossless=args.webp_lossless,
+                   webp_method=args.webp_method, jpeg_quality=args.jpeg_quality,
+                   jpeg_subsampling=args.jpeg_subsampling, premultiplied=args.premultiplied)
+
+def run_serve(service, args):
+    """Run the HTTP service until interrupted"""
+    def ready(server):
+        host, port = server.sockets[0].getsockname()[:2]
+        print(f"Serving on http://{host}:{port} (Ctrl+C to stop)")
+
+    try:
+        asyncio.run(service.serve(args.host, args.port, ready))
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(service.snapshot()))
+    return 0
+
+def measure_startup(root, app, image_path):
+    """Time the desktop app's cold start and quit once the first cutout is shown
+
+    Prints JSON with seconds since process start to the first mapped window,
+    the loaded model and the displayed cutout of image_path.
+    """
+    timings = {"imports_s": round(IMPORTED - STARTED, 3)}
+
+    def elapsed():
+        return round(time.perf_counter() - STARTED, 3)
+
+    def finish():
+        print(json.dumps(timings))
+        root.quit()
+
+    def failed(e):
+        timings["error"] = str(e)
+        finish()
+
+    def cut_out(result):
+        app.show_cutout(result)
+        root.update_idletasks()
+        timings["first_cutout_s"] = elapsed()
+        finish()
+
+    def poll():
+        sessions = app.current_sessions()
+        if sessions.error is not None:
+            return failed(sessions.error)
+        if sessions.is_ready() and "model_ready_s" not in timings:
+            timings["model_ready_s"] = elapsed()
+        if not (sessions.is_ready() and app.input_ready):
+            root.after(10, poll)
+            return
+        app.jobs.submit("remove", lambda job: app.remove_background(image_path, job, sessions),
+                        cut_out, failed)
+
+    def mapped(event):
+        if event.widget is not root or "first_window_s" in timings:
+            return
+        timings["first_window_s"] = elapsed()
+        app.load_input_image(image_path)
+        poll()
+
+    root.bind("<Map>", mapped, add="+")
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    try:
+        sessions = SessionManager(MODEL_TIERS[args.tier] if args.tier else args.model,
+                                  num_threads=args.threads, max_batch=args.batch_size,
+                                  max_wait=args.batch_wait_ms / 1000,
+                                  inter_threads=args.inter_threads, provider=args.provider,
+                                  optimization=args.optimization, model_path=args.model_path)
+        # The desktop app loads the segmentation stack after its window is up
+        if args.command is not None:
+            sessions.validate()
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.command is None:
+        if args.startup_time and not os.path.isfile(args.startup_time):
+            parser.error(f"--startup-time: no such file: {args.startup_time}")
+        try:
+            root = TkinterDnD.Tk()
+        except:
+            root = tk.Tk()
+
+        app = BackgroundRemoverApp(root, sessions=sessions,
+                                   history_bytes=args.history_mb * 1024 * 1024)
+        if args.startup_time:
+            measure_startup(root, app, args.startup_time)
+        root.mainloop()
+        app.jobs.shutdown()
+        return 0
+
+    cache = MaskCache(args.cache_dir, args.cache_size * 1024 * 1024) if args.cache_size else None
+    tracer = Tracer()
+    try:
+        if args.command == "serve":
+            service = RemovalService(sessions, cache, tracer, args.concurrency, args.queue_size,
+                                     encoder_from_args(args))
+            return run_serve(service, args)
+        engine = BatchEngine(sessions, workers=args.workers, effects=args.effect, cache=cache,
+                             tracer=tracer, writers=args.writers, resume=not args.force,
+                             encoder=encoder_from_args(args, args.format, args.kind, args.crop))
+        if args.command == "watch":
+            return run_watch(engine, args)
+        return run_process(engine, args)
+    finally:
+        if args.trace:
+            tracer.export(args.trace)
+
+if __name__ == "__main__":
+    sys.exit(main())